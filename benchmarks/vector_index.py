@@ -0,0 +1,52 @@
+"""
+benchmark of the ranking backends for 100-2000 documents:
+persistent Chroma (what the server used to always do), in-memory Chroma and `InMemoryIndex`.
+embeddings are deterministic fakes, so only the index cost is measured.
+
+run from the repository root:
+    python -m benchmarks.vector_index
+"""
+import os
+import shutil
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from utils.db_utils import InMemoryIndex, set_db, sync_documents
+
+SIZES = [100, 500, 1000, 2000]
+DIMENSION = 1536
+QUERIES = 10
+
+
+def make_documents(n: int):
+    return [Document(page_content=f"abstract of paper {idx}",
+                     metadata={'paperId': f"paper-{idx}", 'title': f"paper {idx}", 'url': '', 'type': 'benchmark'})
+            for idx in range(n)]
+
+
+def run(name: str, db, documents):
+    start = time.perf_counter()
+    sync_documents(db=db, documents=documents)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for idx in range(QUERIES):
+        db.similarity_search_with_score(f"query {idx}", k=10)
+    query = (time.perf_counter() - start) / QUERIES
+    print(f"{name:<20} n={len(documents):<5} build {build * 1000:9.1f} ms  query {query * 1000:7.2f} ms")
+
+
+if __name__ == '__main__':
+    embeddings = DeterministicFakeEmbedding(size=DIMENSION)
+    for n in SIZES:
+        documents = make_documents(n)
+        name = f"benchmark_{n}"
+        if os.path.isdir(f"./db/{name}"):
+            shutil.rmtree(f"./db/{name}")
+        run('chroma (persist)', set_db(name=name, embeddings=embeddings, save_local=True), documents)
+        shutil.rmtree(f"./db/{name}")
+        run('chroma (memory)', set_db(name=name, embeddings=embeddings, save_local=False), documents)
+        run('numpy', InMemoryIndex(embeddings), documents)
@@ -1,13 +1,28 @@
-from fastapi import FastAPI
-from utils.db_utils import set_db, get_embeddings, add_documents
-from utils.semantic_scholar_utils import get_cited_papers, get_citations
-from utils.arxiv_utils import load_paper_arxiv_api, load_paper_arxiv_title
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from utils.db_utils import open_index, get_embeddings, get_local_model, index_lock, sync_documents, document_key, embedding_cache, InMemoryIndex, EMBEDDINGS_BACKEND
+from utils.semantic_scholar_utils import get_cited_papers, get_citations, aget_cited_papers, aget_citations, aiter_graph_documents, get_papers_batch, graph_cache, specter_cache, specter_text, GRAPH_MAX_ITEMS
+from utils.arxiv_utils import load_paper_arxiv_api, load_paper_arxiv_title, strip_version, metadata_cache
 from utils.web_utils import duckduckgoSearch
 from utils.zotero_utils import Zotero
-import time
+from utils.expansion_utils import expand_citation_graph
+from utils.job_utils import JobQueue
+from utils.http_utils import aclose_async_client
+from utils.concurrency_utils import SingleFlight
+from utils.cache_utils import ResultCache
+from utils.rank_utils import hybrid_search, lexical_search
+from utils.corpus_index_utils import search_categories
+from utils.LLM_utils import ajudge_papers_as_completed, llm_cache, set_model
+from utils.metrics_utils import StageTimer, atimed, export_metrics, observe_documents, register_caches, span, timed
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import asyncio
+import hashlib
+import json
 import os
-import shutil
+import re
+import threading
 from pydantic import BaseModel
+from typing import Literal, Optional
 import uvicorn
 
 
@@ -17,10 +32,39 @@ app = FastAPI()
 if not os.path.isdir('./db'):
     os.mkdir('./db')
 
+DAILY_PAPER_WORKERS = int(os.getenv('DAILY_PAPER_WORKERS', 4))
+CATEGORY_CANDIDATES = int(os.getenv('CATEGORY_CANDIDATES', 20))
+JUDGE_MODEL = os.getenv('JUDGE_MODEL', 'llama3-8b-8192')
+# concurrent requests for the same paper share one in-flight graph fetch
+graph_flight = SingleFlight()
+result_cache = ResultCache(
+    max_entries=int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 1000)),
+    ttl=float(os.getenv('RESULT_CACHE_TTL', 60 * 60)),
+    threshold=float(os.getenv('RESULT_CACHE_THRESHOLD', 0.97))
+)
+job_queue = JobQueue(
+    path=os.getenv('JOBS_DB_PATH', './jobs.sqlite3'),
+    max_workers=int(os.getenv('JOB_WORKERS', 2))
+)
+register_caches({
+    'semantic_scholar': graph_cache,
+    'specter': specter_cache,
+    'arxiv': metadata_cache,
+    'embeddings': embedding_cache,
+    'llm': llm_cache,
+    'results': result_cache
+})
+
 
 class nextPaperParams(BaseModel):
     query: str
     arxiv_number: str
+    persist: bool = True  # False: rank with an ephemeral in-memory index instead of a Chroma collection
+    hops: int = 1  # 2-3: also walk the citation graph beyond direct references and citations
+    embeddings: Optional[Literal['openai', 'local', 'specter']] = None  # 'specter': Graph API vectors, ranked in memory; default EMBEDDINGS_BACKEND
+    ranking: Literal['vector', 'hybrid'] = 'vector'  # 'hybrid': BM25 prefilter, vector scoring of the survivors, reciprocal rank fusion (see `format_results` for the scores)
+    category_candidates: int = CATEGORY_CANDIDATES  # similar papers of the seed's categories from the local corpus index
+    insights: bool = False  # judge the results with the LLM to fill their 'read' and 'insights'
 
 
 class nextCollectionPaperParams(BaseModel):
@@ -29,6 +73,82 @@ class nextCollectionPaperParams(BaseModel):
     zotero_api_key: str
     collection_name: str
     query: str
+    persist: bool = True
+    ranking: Literal['vector', 'hybrid'] = 'vector'
+
+
+def format_results(result, score_type: str = 'distance'):
+    """
+    convert the output of `similarity_search_with_score` into the response format.
+    `score_type` tells how to read `score`: 'distance' (vector ranking, lower is closer),
+    'bm25' (lexical ranking, higher is better) or 'rrf' (hybrid ranking, higher is better)
+    """
+    response = []
+    for doc in result:
+        abstract, title = doc[0].page_content, doc[0].metadata['title']
+        inst = {
+            'title': title,
+            'abstract': abstract,
+            'insights': None,
+            'link': doc[0].metadata['url'],
+            'score': doc[1],
+            'score_type': score_type,
+            'type': doc[0].metadata['type']
+        }
+        response.append(inst)
+    return response
+
+
+def sync_index(db, name: str, documents, evict=True):
+    """
+    `sync_documents` under the lock of the collection, so that concurrent requests never embed the same documents twice
+    """
+    with index_lock(db, name):
+        return sync_documents(db=db, documents=documents, evict=evict)
+
+
+def sync_and_search(db, name: str, documents, query: str, k: int = 10):
+    """
+    final sync and ranking of a request, atomic with respect to the other requests on the same collection
+    (whose eviction could otherwise drop this request's documents in between)
+    ## return
+    (result of `similarity_search_with_score`, number of added documents, number of evicted documents)
+    """
+    with index_lock(db, name):
+        db, added, evicted = sync_documents(db=db, documents=documents)
+        return db.similarity_search_with_score(query, k=k), added, evicted
+
+
+async def fill_insights(response: list, query: str):
+    """
+    judge the formatted results concurrently, filling `read` and `insights` in place.
+    yields the index of each result as soon as its verdict is in.
+    """
+    model = set_model(JUDGE_MODEL)
+    papers = [{'title': inst['title'], 'abstract': inst['abstract']} for inst in response]
+    async for idx, verdict in ajudge_papers_as_completed(model, papers, query):
+        if not isinstance(verdict, dict):
+            # the model answered with JSON that is not an object, reported like a failed verdict
+            verdict = {'read': "no", 'insights': str(verdict)}
+        response[idx]['read'] = verdict.get('read')
+        response[idx]['insights'] = verdict.get('insights')
+        yield idx
+
+
+def sse_event(event: str, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.on_event("startup")
+def load_models():
+    # keep the local embedding model warm instead of loading it on the first request
+    if EMBEDDINGS_BACKEND == 'local':
+        get_local_model()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await aclose_async_client()
 
 
 @app.get("/")
@@ -38,60 +158,411 @@ def hi():
     }
 
 
+@app.get("/cacheStats/")
+def cache_stats():
+    return {
+        'semantic_scholar': graph_cache.stats(),
+        'specter': specter_cache.stats(),
+        'arxiv': metadata_cache.stats(),
+        'embeddings': embedding_cache.stats(),
+        'llm': llm_cache.stats(),
+        'results': result_cache.stats()
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus metrics: latency of each stage of the endpoints, upstream calls by host and status,
+    documents per source and cache hits/misses
+    """
+    body, content_type = export_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+def open_paper_index(params: nextPaperParams, embeddings=None):
+    """
+    index of `/whatsNext/`. with SPECTER embeddings the graph documents carry their own vectors,
+    so the index is always in memory and only the query and web results are embedded.
+    hybrid ranking only embeds the candidates of one request, so it is always in memory too.
+    """
+    specter = params.embeddings == 'specter'
+    return open_index(
+        name=params.arxiv_number,
+        embeddings=embeddings or get_embeddings(params.embeddings),
+        persist=params.persist and not specter and params.ranking != 'hybrid',
+        document_text=specter_text if specter else None
+    )
+
+
+def result_options(params: nextPaperParams):
+    """
+    the request parameters besides the query and the paper that change the ranked results
+    (`persist` too: Chroma scores are L2 distances, in-memory scores cosine distances)
+    """
+    return (params.embeddings, params.ranking, params.persist, params.hops, params.category_candidates, params.insights)
+
+
+def invalidate_results(db, arxiv_number: str, changed: int):
+    """
+    drop the cached `/whatsNext/` rankings of the paper once a sync outside `/whatsNext/` changed its persistent collection
+    """
+    if changed > 0 and not isinstance(db, InMemoryIndex):
+        result_cache.invalidate(arxiv_number)
+
+
+def collection_fingerprint(documents):
+    """
+    hash of the ids of the query-independent documents of a paper, which changes whenever its graph does
+    """
+    keys = sorted({document_key(document) for document in documents})
+    return hashlib.sha256("\n".join(keys).encode('utf-8')).hexdigest()
+
+
+def find_category_documents(arxiv_number: str, query: str, embeddings, k: int = CATEGORY_CANDIDATES, categories=None):
+    """
+    papers of the seed paper's arXiv categories closest to the query, from the prebuilt corpus index (`corpus_index_utils`).
+    empty when no index of those categories was built with the same embeddings.
+    """
+    if k <= 0:
+        return []
+    if categories is None:
+        categories = load_paper_arxiv_api(arxiv_id=arxiv_number).categories
+    return search_categories(query, categories, embeddings, k=k, exclude={arxiv_number})
+
+
+async def fetch_graph_documents(arxiv_number: str, hops: int = 1, with_embedding=False):
+    """
+    documents of the citation graph around the paper: direct references and citations,
+    or a budgeted multi-hop expansion when `hops` > 1 (whose documents never carry inline embeddings)
+    """
+    if hops > 1:
+        documents, stats = await asyncio.to_thread(expand_citation_graph, arxiv_number, hops=hops)
+        print(f"expansion: {stats}")
+        return documents
+    (documents, cnt), (citations, cite_cnt) = await asyncio.gather(
+        aget_cited_papers(arxiv_number, with_embedding=with_embedding),
+        aget_citations(arxiv_number, with_embedding=with_embedding)
+    )
+    return documents + citations
+
+
 @app.post("/whatsNext/")
-def next_paper(params: nextPaperParams):
+@timed('whatsNext')
+async def next_paper(params: nextPaperParams):
     query = params.query
     arxiv_number = params.arxiv_number
     print(f"query: {query}")
     print(f"arxiv_number: {arxiv_number}")
     print(f"Searching paper of arxiv number {arxiv_number}...")
-    metadata = load_paper_arxiv_api(arxiv_id=arxiv_number)
+    with_embedding = params.embeddings == 'specter'
+    hybrid = params.ranking == 'hybrid'
+    embeddings = get_embeddings(params.embeddings)
+    # near-duplicate queries for the same paper are answered from `result_cache` without running the pipeline
+    query_vector = await atimed('whatsNext', 'query_embedding', asyncio.to_thread(embeddings.embed_query, query))
+    cached = result_cache.get(arxiv_number, result_options(params), query_vector)
+    if cached is not None:
+        print("served from the result cache")
+        return cached
+    db = open_paper_index(params, embeddings=embeddings)
+    add_lock = asyncio.Lock()
+    added = 0
+
+    async def fetch_and_add(source, fetch):
+        # each source is embedded as soon as it arrives, overlapping with the fetches still in flight
+        # (hybrid ranking embeds only the prefiltered candidates, once everything arrived)
+        nonlocal added
+        documents = await atimed('whatsNext', source, fetch)
+        observe_documents('whatsNext', source, len(documents))
+        if hybrid:
+            return documents
+        async with add_lock:
+            with span('whatsNext', 'embedding'):
+                _, new, _ = await asyncio.to_thread(sync_index, db, arxiv_number, documents, evict=False)
+        added += new
+        return documents
+
+    async def fetch_metadata():
+        # the seed's categories select the local corpus indexes searched for category candidates
+        metadata = await atimed('whatsNext', 'arxiv', asyncio.to_thread(load_paper_arxiv_api, arxiv_id=arxiv_number))
+        category_documents = await fetch_and_add('category', asyncio.to_thread(
+            find_category_documents, arxiv_number, query, db.embeddings,
+            k=params.category_candidates, categories=metadata.categories))
+        return metadata, category_documents
+
+    # arXiv, Semantic Scholar and DuckDuckGo are fetched concurrently;
+    # each upstream is paced by its shared limiter in `rate_limit_utils` instead of fixed sleeps.
+    (metadata, category_documents), graph_documents, searchOutput = await asyncio.gather(
+        fetch_metadata(),
+        fetch_and_add('graph', graph_flight.do((arxiv_number, params.hops, with_embedding), fetch_graph_documents,
+                                               arxiv_number, hops=params.hops, with_embedding=with_embedding)),
+        fetch_and_add('search', asyncio.to_thread(duckduckgoSearch, query=query))
+    )
     title = metadata.title
     categories = metadata.categories
     print(f"title: {title}")
     print(f"categories: {categories}")
-    print("retrieving paper")
-    time.sleep(1)
-    embeddings = get_embeddings()
-    if os.path.isdir(f'./db/{arxiv_number}'):
-        shutil.rmtree(f'./db/{arxiv_number}')
-    db = set_db(
-        name=arxiv_number,
-        embeddings=embeddings,
-        save_local=True
-    )
-    documents, cnt = get_cited_papers(arxiv_number)
-    time.sleep(2.05)
-    citations, cite_cnt = get_citations(arxiv_number)
-    time.sleep(2.05)
-    searchOutput = duckduckgoSearch(query=query)
-    db = add_documents(db=db,
-                       documents=documents)
-    db = add_documents(db=db,
-                       documents=citations)
-    db = add_documents(
-        db=db,
-        documents=searchOutput
-    )
-    print("add documents COMPLETE")
-    result = db.similarity_search_with_score(query=query, k=10)
-    response = []
-    for doc in result:
-        abstract, title = doc[0].page_content, doc[0].metadata['title']
-        inst = {
-            'title': title,
-            'abstract': abstract,
-            'insights': None,
-            'link': doc[0].metadata['url'],
-            'score': doc[1],
-            'type': doc[0].metadata['type']
-        }
-        response.append(inst)
+    with span('whatsNext', 'ranking'):
+        if hybrid:
+            result = await asyncio.to_thread(hybrid_search, db, graph_documents + searchOutput + category_documents,
+                                             query, k=10)
+        else:
+            result, _, evicted = await asyncio.to_thread(
+                sync_and_search, db, arxiv_number, graph_documents + searchOutput + category_documents, query, k=10)
+            print(f"sync documents COMPLETE (added: {added}, evicted: {evicted})")
+    response = format_results(result, 'rrf' if hybrid else 'distance')
+    if params.insights:
+        with span('whatsNext', 'insights'):
+            async for _ in fill_insights(response, query):
+                pass
+    result_cache.set(arxiv_number, result_options(params), query_vector, collection_fingerprint(graph_documents), response)
     return response
 
 
+@app.post("/whatsNext/stream/")
+async def stream_next_paper(params: nextPaperParams):
+    """
+    streaming variant of `/whatsNext/` (Server-Sent Events).
+    each page of each source is embedded as soon as it arrives, followed by a `progress` and a refined `topk` event;
+    a final `done` event carries the ranking after stale documents are evicted.
+    with hybrid ranking the intermediate `topk` events are BM25-only and nothing is embedded before `done`.
+    with `insights`, the final ranking is sent as a `topk` event of stage 'ranking', followed by one `insight` event
+    per result as its verdict completes, before `done`.
+    """
+    query = params.query
+    arxiv_number = params.arxiv_number
+
+    async def events():
+        stream = stream_events()
+        with span('whatsNext_stream', 'total'):
+            try:
+                async for event in stream:
+                    yield event
+            finally:
+                # run the cleanup of `stream_events` as soon as the client disconnects
+                await stream.aclose()
+
+    async def stream_events():
+        with_embedding = params.embeddings == 'specter'
+        hybrid = params.ranking == 'hybrid'
+        db = open_paper_index(params)
+        queue = asyncio.Queue()
+
+        async def produce(stage, pages):
+            # pages: async iterator of document lists; `None` marks the end of the source
+            count = 0
+            with span('whatsNext_stream', stage):
+                try:
+                    async for documents in pages:
+                        count += len(documents)
+                        await queue.put((stage, documents, None))
+                except Exception as e:
+                    await queue.put((stage, [], e))
+            observe_documents('whatsNext_stream', stage, count)
+            await queue.put((stage, None, None))
+
+        async def single(call, *args, **kwargs):
+            output = await asyncio.to_thread(call, *args, **kwargs)
+            yield output[0] if isinstance(output, tuple) else output
+
+        sources = {
+            'references': aiter_graph_documents(arxiv_number, 'references', with_embedding=with_embedding,
+                                                max_items=GRAPH_MAX_ITEMS),
+            'citations': aiter_graph_documents(arxiv_number, 'citations', with_embedding=with_embedding,
+                                               max_items=GRAPH_MAX_ITEMS),
+            'search': single(duckduckgoSearch, query=query)
+        }
+        if params.category_candidates > 0:
+            sources['category'] = single(find_category_documents, arxiv_number, query, db.embeddings,
+                                         k=params.category_candidates)
+        if params.hops > 1:
+            sources['expansion'] = single(expand_citation_graph, arxiv_number, hops=params.hops)
+        producers = [asyncio.ensure_future(produce(stage, pages)) for stage, pages in sources.items()]
+        try:
+            yield sse_event('progress', {'stage': 'fetch', 'sources': list(sources)})
+            all_documents = []
+            remaining = len(producers)
+            while remaining > 0:
+                stage, documents, error = await queue.get()
+                if documents is None:
+                    remaining -= 1
+                    yield sse_event('progress', {'stage': stage, 'finished': True})
+                    continue
+                if error is not None:
+                    yield sse_event('error', {'stage': stage, 'error': str(error)})
+                    continue
+                all_documents += documents
+                if hybrid:
+                    yield sse_event('progress', {'stage': stage, 'documents': len(documents)})
+                    result = await asyncio.to_thread(lexical_search, all_documents, query, k=10)
+                    yield sse_event('topk', {'stage': stage, 'results': format_results(result, 'bm25')})
+                    continue
+                db, added, _ = await asyncio.to_thread(sync_index, db, arxiv_number, documents, evict=False)
+                invalidate_results(db, arxiv_number, added)
+                yield sse_event('progress', {'stage': stage, 'documents': len(documents), 'added': added})
+                result = await asyncio.to_thread(db.similarity_search_with_score, query=query, k=10)
+                yield sse_event('topk', {'stage': stage, 'results': format_results(result)})
+            with span('whatsNext_stream', 'ranking'):
+                if hybrid:
+                    result = await asyncio.to_thread(hybrid_search, db, all_documents, query, k=10)
+                    evicted = 0
+                else:
+                    result, added, evicted = await asyncio.to_thread(sync_and_search, db, arxiv_number, all_documents, query, k=10)
+                    invalidate_results(db, arxiv_number, added + evicted)
+            response = format_results(result, 'rrf' if hybrid else 'distance')
+            if params.insights:
+                yield sse_event('topk', {'stage': 'ranking', 'results': response})
+                with span('whatsNext_stream', 'insights'):
+                    async for idx in fill_insights(response, query):
+                        yield sse_event('insight', {'index': idx, **response[idx]})
+            yield sse_event('done', {'evicted': evicted, 'results': response})
+        finally:
+            # a closed connection (or a failure) must not leave the sources paging upstream
+            for producer in producers:
+                producer.cancel()
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+def resolve_arxiv_ids(papers: list, max_workers: int = DAILY_PAPER_WORKERS):
+    """
+    resolve the (title, DOI) pairs of a zotero collection into (title, arxiv number) pairs.
+    arXiv DOIs are used as they are, other DOIs are resolved with one Semantic Scholar batch call,
+    and only the remaining titles are searched on arXiv, concurrently.
+    """
+    arxivIds = {}
+    dois = {}
+    for title, DOI in papers:
+        match = re.match(r'10\.48550/arxiv\.(.+)', DOI or '', re.IGNORECASE)
+        if match:
+            arxivIds[title] = strip_version(match.group(1))
+        elif DOI:
+            dois[title] = DOI
+    if len(dois) > 0:
+        found = get_papers_batch([f"DOI:{DOI}" for DOI in dois.values()], fields='externalIds')
+        for title, data in zip(dois, found):
+            if data is not None and (data.get('externalIds') or {}).get('ArXiv'):
+                arxivIds[title] = data['externalIds']['ArXiv']
+
+    def search(title):
+        try:
+            metadata = load_paper_arxiv_title(paper_name=title)
+        except Exception as e:
+            print(f"failed to find {title} on arxiv: {e}")
+            return None
+        return strip_version(metadata.get_short_id())
+
+    remaining = [title for title, _ in papers if title not in arxivIds]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for title, arxivId in zip(remaining, pool.map(search, remaining)):
+            if arxivId is not None:
+                arxivIds[title] = arxivId
+    return [(title, arxivIds[title]) for title, _ in papers if title in arxivIds]
+
+
 @app.post("/DailyPaper/")
 def next_collection_paper(params: nextCollectionPaperParams):
+    return run_collection_pipeline(params)
+
+
+@app.post("/DailyPaper/stream/")
+async def stream_collection_paper(params: nextCollectionPaperParams):
+    """
+    streaming variant of `/DailyPaper/` (Server-Sent Events) with `progress` events per stage,
+    a refined `topk` event after each source is embedded and a final `done` event
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    def progress(stage, **info):
+        results = info.pop('results', None)
+        emit('progress', {'stage': stage, **info})
+        if results is not None:
+            emit('topk', {'stage': stage, 'results': results})
+
+    # set once the client is gone, so that the pipeline stops at its next stage
+    cancelled = threading.Event()
+
+    def run():
+        try:
+            emit('done', {'results': run_collection_pipeline(params, progress=progress, incremental=True,
+                                                             cancelled=cancelled)})
+        except CancelledError:
+            pass
+        except Exception as e:
+            emit('error', {'error': str(e)})
+        emit(None, None)
+
+    async def events():
+        worker = asyncio.ensure_future(asyncio.to_thread(run))
+        try:
+            while True:
+                event, data = await queue.get()
+                if event is None:
+                    break
+                yield sse_event(event, data)
+            await worker
+        finally:
+            cancelled.set()
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+@app.post("/DailyPaper/jobs/")
+def submit_collection_paper_job(params: nextCollectionPaperParams):
+    job_id = job_queue.submit('DailyPaper', run_collection_pipeline, params)
+    return {
+        'job_id': job_id,
+        'status': 'queued'
+    }
+
+
+@app.get("/DailyPaper/jobs/{job_id}")
+def get_collection_paper_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} does not exist.")
+    job.pop('result')
+    return job
+
+
+@app.get("/DailyPaper/jobs/{job_id}/result")
+def get_collection_paper_job_result(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} does not exist.")
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=500, detail=job['error'])
+    if job['status'] != 'done':
+        job.pop('result')
+        return JSONResponse(status_code=202, content=job)
+    return job['result']
+
+
+def run_collection_pipeline(params: nextCollectionPaperParams, progress=None, incremental=False, cancelled=None):
+    """
+    the `/DailyPaper/` pipeline: zotero collection -> arxiv ids -> references, citations and web search -> ranking
+    ## args
+    - params: request parameters
+    - progress: optional callback `progress(stage, **info)` called as each stage finishes
+    - incremental: embed and rank after each source, reporting the top-k as `results` of its stage
+    - cancelled: optional `threading.Event`; once it is set, the pipeline raises `CancelledError` after the current stage
+    """
+    # every `progress` call closes a stage, so that the time between two calls is recorded as the later stage
+    timer = StageTimer('DailyPaper')
+    report = progress
+
+    def progress(stage, **info):
+        timer.mark(stage)
+        if 'documents' in info:
+            observe_documents('DailyPaper', stage, info['documents'])
+        if report is not None:
+            report(stage, **info)
+        if cancelled is not None and cancelled.is_set():
+            raise CancelledError(f"cancelled after {stage}")
     library_id = params.library_id
     library_type = params.library_type
     zotero_api_key = params.zotero_api_key
@@ -106,66 +577,62 @@ def next_collection_paper(params: nextCollectionPaperParams):
     collection_names = [name for name in collection_dict]
     print(f"collections: {collection_names}")
     db_name = collection_name.replace(" ", "_")
-    if os.path.isdir(f"./db/{db_name}"):
-        shutil.rmtree(f"./db/{db_name}")
     key = collection_dict[collection_name]
     paper = zot.retrieve_collection_papers(key=key)
-    arxivIds = []
-    titles = []
-    for title, DOI in paper:
-        metadata = load_paper_arxiv_title(paper_name=title)
-        arxivId = metadata.entry_id.split('/')[-1]
-        if 'v' in arxivId:
-            arxivId = arxivId.split('v')[0]
-        arxivIds.append((title, arxivId))
-        titles.append(title)
-
-    total_paper_db = []
-    title_set = set()
-    for title, arxivId in arxivIds:
-        time.sleep(2.05)
-        citations, cite_cnt = get_citations(arxiv_id=arxivId)
-        for citation in citations:
-            if citation.metadata['title'] not in title_set and citation.metadata['title'] not in titles:
-                title_set.add(citation.metadata['title'])
-                total_paper_db.append(citation)
-
-    for title, arxivId in arxivIds:
-        time.sleep(2.05)
-        cited_papers, cited_cnt = get_cited_papers(arxiv_id=arxivId)
-        for cited_paper in cited_papers:
-            if cited_paper.metadata['title'] not in title_set and cited_paper.metadata['title'] not in titles:
-                title_set.add(cited_paper.metadata['title'])
-                total_paper_db.append(cited_paper)
-
-    searchOutput = duckduckgoSearch(query=query)
-    for doc in searchOutput:
-        if doc.metadata['title'] not in title_set and doc.metadata['title'] not in titles:
-            title_set.add(doc.metadata['title'])
-            total_paper_db.append(doc)
+    progress('zotero', papers=len(paper))
+    arxivIds = resolve_arxiv_ids(paper)
+    titles = [title for title, _ in paper]
+    progress('resolve', resolved=len(arxivIds))
+    hybrid = params.ranking == 'hybrid'
     embeddings = get_embeddings()
-    db = set_db(
+    db = open_index(
         name=db_name,
         embeddings=embeddings,
-        save_local=True
+        persist=params.persist and not hybrid
     )
-    db = add_documents(
-        db=db,
-        documents=total_paper_db
-    )
-    result = db.similarity_search_with_score(query, k=10)
-    response = []
-    for doc in result:
-        abstract, title = doc[0].page_content, doc[0].metadata['title']
-        inst = {
-            'title': title,
-            'abstract': abstract,
-            'insights': None,
-            'link': doc[0].metadata['url'],
-            'score': doc[1],
-            'type': doc[0].metadata['type']
-        }
-        response.append(inst)
+
+    total_paper_db = []
+    title_set = set()
+
+    def add_source(stage, outputs):
+        new_documents = []
+        for doc in outputs:
+            if doc.metadata['title'] not in title_set and doc.metadata['title'] not in titles:
+                title_set.add(doc.metadata['title'])
+                new_documents.append(doc)
+        total_paper_db.extend(new_documents)
+        info = {'documents': len(new_documents)}
+        if incremental and hybrid:
+            info['results'] = format_results(lexical_search(total_paper_db, query, k=10), 'bm25')
+        elif incremental:
+            _, info['added'], _ = sync_index(db, db_name, new_documents, evict=False)
+            info['results'] = format_results(db.similarity_search_with_score(query, k=10))
+        progress(stage, **info)
+
+    # graph fetches and the web search run concurrently; upstream pacing is left to the shared limiters
+    pool = ThreadPoolExecutor(max_workers=DAILY_PAPER_WORKERS)
+    try:
+        search_future = pool.submit(duckduckgoSearch, query=query)
+        citation_results = pool.map(get_citations, [arxivId for _, arxivId in arxivIds])
+        cited_results = pool.map(get_cited_papers, [arxivId for _, arxivId in arxivIds])
+        add_source('references', [citation for citations, cite_cnt in citation_results for citation in citations])
+        add_source('citations', [cited_paper for cited_papers, cited_cnt in cited_results for cited_paper in cited_papers])
+        add_source('search', search_future.result())
+    finally:
+        # a cancelled (or failed) run does not start the fetches still queued
+        pool.shutdown(cancel_futures=True)
+
+    if hybrid:
+        response = format_results(hybrid_search(db, total_paper_db, query, k=10), 'rrf')
+        progress('ranking', count=len(response))
+        timer.total()
+        return response
+    result, added, evicted = sync_and_search(db, db_name, total_paper_db, query, k=10)
+    print(f"sync documents COMPLETE (added: {added}, evicted: {evicted})")
+    progress('embedding', added=added, evicted=evicted)
+    response = format_results(result)
+    progress('ranking', count=len(response))
+    timer.total()
     return response
 
 if __name__ == '__main__':
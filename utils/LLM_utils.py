@@ -1,54 +1,106 @@
 from langchain_groq import ChatGroq
-from langchain.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+import hashlib
+import json
 import os
-from dotenv import find_dotenv, load_dotenv
+import threading
+from utils.cache_utils import LLMCache
+from utils.metrics_utils import count_upstream, upstream_call
+from utils.settings_utils import HTTP_READ_TIMEOUT
+
+JUDGE_CONCURRENCY = int(os.getenv('JUDGE_CONCURRENCY', 5))
+LLM_HOST = 'api.groq.com'
+llm_cache = LLMCache(
+    name='llm',
+    max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', 100000))
+)
+# bump the version of a prompt whenever its template changes, so that outputs of the old template are not served
+PROMPT_VERSIONS = {
+    'query_rewrite': 1,
+    'judge_cite_paper': 1,
+    'judge_paper': 1
+}
+
+_models = {}
+_models_lock = threading.Lock()
+
 
 def set_model(name:str):
-    load_dotenv(find_dotenv())
-    if name == 'llama3-8b-8192':
-        os.environ['GROQ_API_KEY'] = os.getenv('GROQ_API_KEY')
-        llm = ChatGroq(model=name)
-    elif name == "New model":
-        pass
-    else:
-        raise Exception(f"{name} is currently not supported.")
-    return llm
+    """
+    return the chat model `name`, constructed once per process and shared across requests
+    """
+    with _models_lock:
+        if name not in _models:
+            if name == 'llama3-8b-8192':
+                llm = ChatGroq(model=name, timeout=HTTP_READ_TIMEOUT)
+            elif name == "New model":
+                pass
+            else:
+                raise Exception(f"{name} is currently not supported.")
+            _models[name] = llm
+        return _models[name]
+
+
+def llm_key(model, prompt_name: str, inputs: dict):
+    """
+    cache key of an LLM call: model, prompt template version and inputs with whitespace collapsed
+    """
+    normalized = {key: " ".join(str(value).split()) for key, value in inputs.items()}
+    payload = json.dumps([getattr(model, 'model_name', type(model).__name__), prompt_name,
+                          PROMPT_VERSIONS[prompt_name], normalized], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def invoke_cached(model, prompt_name: str, chain, inputs: dict):
+    """
+    `chain.invoke(inputs)` served from `llm_cache` when the same call was made before
+    """
+    key = llm_key(model, prompt_name, inputs)
+    output = llm_cache.get(key)
+    if output is None:
+        with upstream_call(LLM_HOST):
+            output = chain.invoke(inputs)
+        llm_cache.set(key, output)
+    return output
+
+
+query_rewrite_prompt = ChatPromptTemplate([
+    ('system', "You have a talent in rewriting a query that has a shorter length than the given query, while maintaining the semantic meaning of the given query. Please only return your output without giving any preambles or reasons."),
+    ('human', "query to rewrite: {query}")
+])
+
 
 def query_rewrite(model, query) -> str:
-    sys_msg="You have a talent in rewriting a query that has a shorter length than the given query, while maintaining the semantic meaning of the given query. Please only return your output without giving any preambles or reasons."
-    human_msg="query to rewrite: {query}"
-    prompt = ChatPromptTemplate([
-        ('system', sys_msg),
-        ('human', human_msg)
-    ])
-    chain = prompt | model
-    output = chain.invoke({'query': query})
-    return output.content
+    chain = query_rewrite_prompt | model | StrOutputParser()
+    return invoke_cached(model, 'query_rewrite', chain, {'query': query})
 
 
-def judge_cite_paper(model, title, abstract, query, keyword):
-    sys_msg="You are a prominent AI researcher and you need to help students by telling them whether they should put the given paper into their research paper or not. \
+JUDGE_CITE_PAPER_SYSTEM = "You are a prominent AI researcher and you need to help students by telling them whether they should put the given paper into their research paper or not. \
             You will be given the title, and abstract of the paper as an input. Based on the student's intention and their keyword, tell them whether to add the given paper or not. \
             Additionally, if they need to put the given paper into their research paper, give some reasons they should put the given paper to their research paper based on the given abstract. \
             You should strictly follow the JSON format of the output, which contains \"put\", \"reason\" as a key. Each of the key describes the following: \
                 - \"put\": whether the student should put the given paper. (\'yes\' or \'no\')\n \
                 - \"reason\": the reason for the given paper.\n \
                 Now, begin!"
-    human_msg="""title of the paper: {title}
+JUDGE_CITE_PAPER_HUMAN = """title of the paper: {title}
     abstract of the paper: {abstract}
     
     student's keyword: {keyword}
     student's intention for reading the paper: {query}
     output:
     """
-    prompt = ChatPromptTemplate([
-        ('system', sys_msg),
-        ('human', human_msg)
-    ])
-    chain = prompt | model | JsonOutputParser()
+judge_cite_paper_prompt = ChatPromptTemplate([
+    ('system', JUDGE_CITE_PAPER_SYSTEM),
+    ('human', JUDGE_CITE_PAPER_HUMAN)
+])
+
+
+def judge_cite_paper(model, title, abstract, query, keyword):
+    chain = judge_cite_paper_prompt | model | JsonOutputParser()
     try:
-        output = chain.invoke({'title': title, 'abstract': abstract, 'query': query, 'keyword': keyword})
+        output = invoke_cached(model, 'judge_cite_paper', chain,
+                               {'title': title, 'abstract': abstract, 'query': query, 'keyword': keyword})
     except Exception as e:
         output = {
             'put': "no",
@@ -56,32 +108,68 @@ def judge_cite_paper(model, title, abstract, query, keyword):
         }
     return output
 
-def judge_paper(model, title, abstract, query):
-    sys_msg= "You are a prominent AI researcher and you need to help students by telling them whether they should read the given paper or not. \
+
+JUDGE_PAPER_SYSTEM = "You are a prominent AI researcher and you need to help students by telling them whether they should read the given paper or not. \
             You will be given the title, and abstract of the paper as an input. Based on the student's intention, tell them whether to read them or not. \
             Additionally, if they need to read the given paper, give some insights, and some focus point while reading the paper based on the given abstract. \
             You should strictly follow the JSON format of the output, which contains \"read\", \"insights\" as a key. Each of the key describes the following: \
                 - \"read\": whether the student should read the given paper. (\'yes\' or \'no\')\n \
                 - \"insights\": the insight or focus point while reading the given paper.\n \
                 Now, begin!"
-    human_msg="""title of the paper: {title}
+JUDGE_PAPER_HUMAN = """title of the paper: {title}
     abstract of the paper: {abstract}
 
     student's intention for reading the paper: {query}
     output:
     """
-    prompt = ChatPromptTemplate([
-        ('system', sys_msg),
-        ('human', human_msg)
-    ])
-    chain = prompt | model | JsonOutputParser()
+judge_paper_prompt = ChatPromptTemplate([
+    ('system', JUDGE_PAPER_SYSTEM),
+    ('human', JUDGE_PAPER_HUMAN)
+])
+
+
+def judge_paper(model, title, abstract, query):
+    chain = judge_paper_prompt | model | JsonOutputParser()
     try:
-        output = chain.invoke({'title': title, 'abstract': abstract, 'query': query})
+        output = invoke_cached(model, 'judge_paper', chain, {'title': title, 'abstract': abstract, 'query': query})
     except Exception as e:
         output = {
             'read': "no",
             'insights': e
         }
     return output
-    
-    
\ No newline at end of file
+
+
+async def ajudge_papers_as_completed(model, papers: list, query: str, max_concurrency: int = JUDGE_CONCURRENCY):
+    """
+    judge many papers with `judge_paper`'s prompt, at most `max_concurrency` calls at a time.
+    verdicts are shared with `judge_paper` through `llm_cache`; cached ones are yielded first.
+    ## args
+    - papers: list of dicts with `title` and `abstract`
+    ## return
+    async generator of (index in `papers`, verdict) in completion order
+    """
+    inputs = [{'title': paper['title'], 'abstract': paper['abstract'], 'query': query} for paper in papers]
+    keys = [llm_key(model, 'judge_paper', paper_inputs) for paper_inputs in inputs]
+    pending = []
+    for idx, key in enumerate(keys):
+        verdict = llm_cache.get(key)
+        if verdict is not None:
+            yield idx, verdict
+        else:
+            pending.append(idx)
+    if len(pending) == 0:
+        return
+    chain = judge_paper_prompt | model | JsonOutputParser()
+    async for position, output in chain.abatch_as_completed(
+            [inputs[idx] for idx in pending], config={'max_concurrency': max_concurrency}, return_exceptions=True):
+        idx = pending[position]
+        # calls of a batch overlap, so they are counted but not timed (see the 'insights' stage)
+        count_upstream(LLM_HOST, type(output).__name__ if isinstance(output, Exception) else 'ok')
+        if isinstance(output, Exception):
+            # failures are reported like `judge_paper` does, but not cached
+            yield idx, {'read': "no", 'insights': str(output)}
+            continue
+        llm_cache.set(keys[idx], output)
+        yield idx, output
+
@@ -1,40 +1,177 @@
 import arxiv
-from sklearn.neighbors import NearestNeighbors
-import json
-from langchain_core.documents import Document
-from tqdm import tqdm
+from datetime import datetime
+import os
+import re
+from utils.cache_utils import ResponseCache
+from utils.corpus_utils import TOKEN_PATTERN, category_path, get_corpus, iter_jsonl, record_to_paper, validate_categories
+from utils.http_utils import get_session
+from utils.rate_limit_utils import RETRY_STATUS, call_with_retries, get_limiter, retry_after_seconds
+
+ARXIV_PAGE_SIZE = 100
+# arxiv id in an abs/pdf/html link: new-style (2301.12345) or old-style (hep-th/9901001), with an optional version
+ARXIV_LINK_PATTERN = re.compile(
+    r"arxiv\.org/(?:abs|pdf|html)/((?:\d{4}\.\d{4,5}|[a-z\-]+(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?)(?:\.pdf)?(?![\w.])")
+
+# pacing is done by the shared limiter of export.arxiv.org, not by the client itself
+arxiv_client = arxiv.Client(page_size=ARXIV_PAGE_SIZE, delay_seconds=0, num_retries=0)
+# the client keeps a private session without any timeout; use the pooled one of `http_utils` instead
+arxiv_client._session = get_session('export.arxiv.org')
+arxiv_limiter = get_limiter('export.arxiv.org')
+
+
+def penalize_retry_after(response, *args, **kwargs):
+    # `arxiv.HTTPError` does not carry the response, so `Retry-After` is applied to the limiter as it arrives
+    if response.status_code in RETRY_STATUS:
+        wait = retry_after_seconds(response.headers)
+        if wait is not None:
+            arxiv_limiter.penalize(wait)
+
+
+arxiv_client._session.hooks['response'].append(penalize_retry_after)
+metadata_cache = ResponseCache(
+    name='arxiv',
+    ttl=float(os.getenv('ARXIV_CACHE_TTL', 60 * 60 * 24 * 7)),
+    stale_ttl=0
+)
+
+
+def first_result(search):
+    """
+    return the first result of an arxiv search, paced by `arxiv_limiter` and retried on 429/503
+    """
+    return call_with_retries('export.arxiv.org', lambda: next(arxiv_client.results(search)), record_upstream=False)
+
+
+def all_results(search):
+    """
+    return every result of an arxiv search, paced by `arxiv_limiter` and retried on 429/503
+    """
+    return call_with_retries('export.arxiv.org', lambda: list(arxiv_client.results(search)), record_upstream=False)
+
+
+def strip_version(arxiv_id: str):
+    return re.sub(r'v\d+$', '', arxiv_id)
+
+
+def link_to_arxiv_id(link: str):
+    """
+    arxiv number (without version) of an arxiv.org link, or `None` if the link does not point to a paper
+    """
+    match = ARXIV_LINK_PATTERN.search(link)
+    if match is None:
+        return None
+    return strip_version(match.group(1))
+
+
+def result_to_dict(result):
+    return {
+        'entry_id': result.entry_id,
+        'title': result.title,
+        'summary': result.summary,
+        'authors': [author.name for author in result.authors],
+        'published': result.published.isoformat(),
+        'updated': result.updated.isoformat(),
+        'primary_category': result.primary_category,
+        'categories': result.categories,
+        'doi': result.doi
+    }
+
+
+def result_from_dict(data: dict):
+    return arxiv.Result(
+        entry_id=data['entry_id'],
+        title=data['title'],
+        summary=data['summary'],
+        authors=[arxiv.Result.Author(name) for name in data['authors']],
+        published=datetime.fromisoformat(data['published']),
+        updated=datetime.fromisoformat(data['updated']),
+        primary_category=data['primary_category'],
+        categories=data['categories'],
+        doi=data['doi']
+    )
+
+
+def load_papers_arxiv_api(arxiv_ids: list):
+    """
+    resolve the metadata of many arxiv papers with batched `id_list` queries
+    ## args
+    - arxiv_ids: arxiv numbers without version
+    ## return
+    dict of arxiv number -> `arxiv.Result` (papers that were not found are missing)
+    """
+    papers = {}
+    missing = []
+    for arxiv_id in dict.fromkeys(arxiv_ids):
+        entry = metadata_cache.get(arxiv_id)
+        if entry is not None and entry[1] <= metadata_cache.ttl:
+            metadata_cache.hits += 1
+            papers[arxiv_id] = result_from_dict(entry[0])
+        else:
+            metadata_cache.misses += 1
+            missing.append(arxiv_id)
+    for start in range(0, len(missing), ARXIV_PAGE_SIZE):
+        chunk = missing[start:start + ARXIV_PAGE_SIZE]
+        search_by_id = arxiv.Search(id_list=chunk, max_results=len(chunk))
+        try:
+            results = all_results(search_by_id)
+        except arxiv.HTTPError as e:
+            # e.g. 400 for an id arxiv does not accept: the papers of this chunk are skipped
+            print(f"arxiv id_list query failed ({e})")
+            continue
+        for result in results:
+            arxiv_id = strip_version(result.get_short_id())
+            metadata_cache.set(arxiv_id, result_to_dict(result))
+            papers[arxiv_id] = result
+    return papers
 
 
 def load_paper_arxiv_api(arxiv_id: str):
-    client = arxiv.Client()
-    search_by_id = arxiv.Search(id_list=[arxiv_id])
-    result = next(client.results(search_by_id))
-    return result
+    papers = load_papers_arxiv_api([arxiv_id])
+    if arxiv_id not in papers:
+        raise Exception(f"arxiv paper {arxiv_id} does not exist.")
+    return papers[arxiv_id]
 
 
 def load_paper_arxiv_title(paper_name: str):
-    client = arxiv.Client()
     search_by_query = arxiv.Search(query=paper_name, max_results=1)
-    result = next(client.results(search_by_query))
+    result = first_result(search_by_query)
     return result
 
 
-def retrieve_paper(category_list: list):
-    papers = []
+def retrieve_paper(category_list: list, query: str = None, min_year: int = None, limit: int = None):
+    """
+    lazily yield the papers of the arxiv categories (each paper once) as dicts with `id`, `title`, `abstract` and `year`.
+    categories built into the corpus (`python -m utils.corpus_utils build ...`) are served from its index,
+    and `query`/`min_year` filter inside SQLite; other dumps are streamed line by line.
+    """
+    validate_categories(category_list)
+    corpus = get_corpus()
+    built = corpus.built_categories()
+    indexed = [category_name for category_name in category_list if category_name in built]
+    streamed = [category_name for category_name in category_list if category_name not in built]
+    count = 0
     paperId = set()
-    for category_name in category_list:
-        with open(f'./arxiv/category/{category_name}.jsonl', 'r') as f:
-            lines = f.readlines()
-        for line in lines:
-            data = json.loads(line)
-            if data['id'] not in paperId:
-                paperId.add(data['id'])
-                inst = {
-                    'id': data['id'],
-                    'title': data['title'],
-                    'abstract': data['abstract'],
-                    'year': data['update_date'].split('-')[0]
-                }
-                papers.append(inst)
+    if len(indexed) > 0:
+        for paper in corpus.iter_papers(indexed, query=query, min_year=min_year, limit=limit):
+            if len(streamed) > 0:
+                paperId.add(paper['id'])
+            count += 1
+            yield paper
+    for category_name in streamed:
+        for data in iter_jsonl(category_path(category_name)):
+            if limit is not None and count >= limit:
+                return
+            if data['id'] in paperId:
+                continue
+            paper = record_to_paper(data)
+            if min_year is not None and int(paper['year']) < min_year:
+                continue
+            if query is not None and not query_terms(query) & query_terms(f"{paper['title']} {paper['abstract']}"):
+                continue
+            paperId.add(data['id'])
+            count += 1
+            yield paper
 
-    return papers
+
+def query_terms(text: str):
+    return set(TOKEN_PATTERN.findall(text.lower()))
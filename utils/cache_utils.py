@@ -0,0 +1,397 @@
+from array import array
+import asyncio
+from collections import OrderedDict
+import copy
+import json
+import numpy as np
+import os
+import sqlite3
+import threading
+import time
+from utils import settings_utils  # noqa: F401 (loads .env before the settings below are read)
+
+CACHE_DIR = os.getenv('CACHE_DIR', './cache')
+
+
+class ResponseCache:
+    """
+    disk-backed (SQLite) cache for JSON responses of upstream APIs
+    ## args
+    - name: name of the cache file under `CACHE_DIR`
+    - ttl: seconds an entry is served as fresh
+    - stale_ttl: extra seconds an expired entry is still served while it is refreshed in the background
+    - max_entries: maximum number of entries kept on disk; entries past `ttl + stale_ttl` are deleted as well
+    """
+
+    def __init__(self, name: str, ttl: float = 60 * 60 * 24, stale_ttl: float = 60 * 60 * 24 * 7,
+                 max_entries: int = 100000):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._tasks = set()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self._conn.commit()
+
+    def get(self, key: str):
+        """
+        return `(value, age)` of the cached entry, or `None` if there is no entry
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), time.time() - row[1]
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now))
+            self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl - self.stale_ttl,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at ASC LIMIT ?)",
+                    (count - self.max_entries,))
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def get_or_fetch(self, key: str, fetch):
+        """
+        return the cached value of `key`, calling `fetch()` on a miss.
+        `fetch` should return `None` on failure so that failures are not cached.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            value, age = entry
+            if age <= self.ttl:
+                self.hits += 1
+                return value
+            if age <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._refresh_in_background(key, fetch)
+                return value
+        self.misses += 1
+        value = fetch()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    async def aget_or_fetch(self, key: str, fetch):
+        """
+        async version of `get_or_fetch`, where `fetch` is a coroutine function
+        """
+        entry = self.get(key)
+        if entry is not None:
+            value, age = entry
+            if age <= self.ttl:
+                self.hits += 1
+                return value
+            if age <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._arefresh_in_background(key, fetch)
+                return value
+        self.misses += 1
+        value = await fetch()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def _arefresh_in_background(self, key: str, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        async def refresh():
+            try:
+                value = await fetch()
+                if value is not None:
+                    self.set(key, value)
+            except Exception as e:
+                print(f"failed to refresh cache entry {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _refresh_in_background(self, key: str, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                value = fetch()
+                if value is not None:
+                    self.set(key, value)
+            except Exception as e:
+                print(f"failed to refresh cache entry {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stats(self):
+        total = self.hits + self.stale_hits + self.misses
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.stale_hits) / total if total else 0.0
+        }
+
+
+class EmbeddingCache:
+    """
+    disk-backed (SQLite) store of embedding vectors keyed by content hash, evicting least recently used entries
+    ## args
+    - name: name of the cache file under `CACHE_DIR`
+    - max_entries: maximum number of vectors kept on disk
+    """
+
+    def __init__(self, name: str, max_entries: int = 200000):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._conn.commit()
+
+    def get_many(self, keys: list, batch_size: int = 500):
+        """
+        return `{key: vector}` for the keys that are stored
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), batch_size):
+                chunk = keys[start:start + batch_size]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall()
+                for key, vector in rows:
+                    found[key] = array('f', vector).tolist()
+                if len(rows) > 0:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows])
+            self._conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array('f', vector).tobytes(), now) for key, vector in items.items()])
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,))
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class LLMCache:
+    """
+    disk-backed (SQLite) store of JSON outputs of LLM calls, evicting least recently used entries
+    ## args
+    - name: name of the cache file under `CACHE_DIR`
+    - max_entries: maximum number of outputs kept on disk
+    """
+
+    def __init__(self, name: str, max_entries: int = 100000):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+            self._conn.commit()
+
+    def get(self, key: str):
+        """
+        return the stored output, or `None`
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM outputs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE outputs SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs (key, value, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()))
+            count = self._conn.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM outputs WHERE key IN (SELECT key FROM outputs ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,))
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class ResultCache:
+    """
+    in-memory LRU cache of ranked results per seed paper, matched by query embedding:
+    a query whose embedding is within `threshold` cosine similarity of a cached query (with the same options)
+    reuses its results. entries expire after `ttl`, and all entries of a seed and options are dropped
+    as soon as their collection is seen with another fingerprint, or changed elsewhere (`invalidate`).
+    ## args
+    - max_entries: maximum number of cached result lists
+    - ttl: seconds an entry is served
+    - threshold: minimum cosine similarity between the queries
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 60 * 60, threshold: float = 0.97):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._fingerprints = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def get(self, seed: str, options, vector):
+        """
+        return the results of the closest cached query of `seed`, or `None`
+        """
+        vector = self._normalize(vector)
+        now = time.time()
+        best_id, best_score = None, self.threshold
+        with self._lock:
+            for entry_id, entry in list(self._entries.items()):
+                if now - entry['created_at'] > self.ttl:
+                    del self._entries[entry_id]
+                    continue
+                if entry['seed'] != seed or entry['options'] != options or len(entry['vector']) != len(vector):
+                    continue
+                score = float(entry['vector'] @ vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return copy.deepcopy(self._entries[best_id]['results'])
+
+    def set(self, seed: str, options, vector, fingerprint: str, results):
+        """
+        cache `results` of a query of `seed` whose collection had `fingerprint`.
+        the fingerprint may depend on the options (e.g. the number of hops), so it is tracked per (seed, options)
+        """
+        with self._lock:
+            if self._fingerprints.get((seed, options)) != fingerprint:
+                # the collection changed: results of earlier queries may be outdated
+                for entry_id in [entry_id for entry_id, entry in self._entries.items()
+                                 if entry['seed'] == seed and entry['options'] == options]:
+                    del self._entries[entry_id]
+                self._fingerprints[(seed, options)] = fingerprint
+            self._entries[self._next_id] = {
+                'seed': seed,
+                'options': options,
+                'vector': self._normalize(vector),
+                'results': copy.deepcopy(results),
+                'created_at': time.time()
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            keys = {(entry['seed'], entry['options']) for entry in self._entries.values()}
+            for stale_key in [stale_key for stale_key in self._fingerprints if stale_key not in keys]:
+                del self._fingerprints[stale_key]
+
+    def invalidate(self, seed: str):
+        """
+        drop every entry of `seed`, e.g. after its collection was changed by a request that does not cache its results
+        """
+        with self._lock:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry['seed'] == seed]:
+                del self._entries[entry_id]
+            for key in [key for key in self._fingerprints if key[0] == seed]:
+                del self._fingerprints[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries)
+        }
@@ -0,0 +1,67 @@
+import asyncio
+from contextlib import contextmanager
+import threading
+import weakref
+
+
+class SingleFlight:
+    """
+    coalesce concurrent calls with the same key: the first caller starts the coroutine,
+    later callers await the same result until it finishes. results are not kept afterwards.
+    the call is cancelled once every caller awaiting it has been cancelled.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._waiters = {}
+
+    async def do(self, key, afn, *args, **kwargs):
+        """
+        return `await afn(*args, **kwargs)`, shared with every concurrent call of the same `key`
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(afn(*args, **kwargs))
+            self._inflight[key] = future
+            self._waiters[key] = 0
+
+            def forget(done):
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+                    del self._waiters[key]
+
+            future.add_done_callback(forget)
+        self._waiters[key] += 1
+        try:
+            # a cancelled caller (e.g. a closed connection) must not cancel the call the others are waiting on,
+            # but the last one to leave stops it
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done() and self._inflight.get(key) is future:
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0:
+                    future.cancel()
+            raise
+
+    def inflight(self):
+        return len(self._inflight)
+
+
+class KeyedLocks:
+    """
+    one `threading.Lock` per key, created on demand and dropped once nobody holds a reference to it
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[key] = lock
+        with lock:
+            yield
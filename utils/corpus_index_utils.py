@@ -0,0 +1,241 @@
+"""
+precomputed vector index over the arXiv category corpus (see `corpus_utils`), for nearest-neighbour candidates
+without any upstream call at query time.
+
+each category is stored in `./arxiv/index/{category}/` as a memory-mapped float16 matrix of normalized abstract
+embeddings, grouped by inverted list (IVF): a query only scans the `nprobe` lists whose centroids are closest.
+
+build the index of some categories from the repository root (after `python -m utils.corpus_utils build ...`):
+    python -m utils.corpus_index_utils build cs.LG cs.CL
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from langchain_core.documents import Document
+from utils.arxiv_utils import retrieve_paper
+from utils.category_list import category_map
+from utils.corpus_utils import get_corpus, validate_categories
+from utils.db_utils import get_embeddings
+
+CORPUS_INDEX_DIR = os.getenv('ARXIV_CORPUS_INDEX_DIR', './arxiv/index')
+CORPUS_INDEX_NPROBE = int(os.getenv('ARXIV_CORPUS_INDEX_NPROBE', 8))
+EMBED_CHUNK_SIZE = 4096
+KMEANS_ITERATIONS = 10
+# training points per inverted list
+KMEANS_SAMPLE_RATIO = 64
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def train_centroids(sample, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0):
+    """
+    spherical k-means: centroids of `nlist` clusters of the normalized `sample`
+    """
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=nlist)
+        # an empty list keeps its previous centroid
+        centroids[counts > 0] = normalize(sums[counts > 0])
+    return centroids
+
+
+def assign(vectors, centroids, chunk_size: int = EMBED_CHUNK_SIZE):
+    return np.concatenate([np.argmax(np.asarray(vectors[start:start + chunk_size], dtype=np.float32) @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), chunk_size)])
+
+
+def build_corpus_index(category: str, embeddings=None, model_name: str = None, nlist: int = None,
+                       index_dir: str = CORPUS_INDEX_DIR, chunk_size: int = EMBED_CHUNK_SIZE):
+    """
+    embed the abstracts of a category of the corpus and write its IVF index
+    ## args
+    - category: arxiv category
+    - embeddings: embeddings of the index (the deployment's embeddings by default, bypassing the embedding cache)
+    - model_name: name of the embeddings model, checked against the query embeddings in `search_categories`
+    - nlist: number of inverted lists (about the square root of the number of papers by default)
+    - chunk_size: number of abstracts embedded at once
+    ## return
+    the metadata of the index
+    """
+    validate_categories([category])
+    if embeddings is None:
+        cached = get_embeddings()
+        embeddings, model_name = cached.embeddings, cached.model_name
+    model_name = model_name or getattr(embeddings, 'model_name', None)
+    path = os.path.join(index_dir, category)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # embed in chunks, appending the raw float16 rows so that the corpus is never held in memory
+    ids = []
+    dimension = None
+    raw_path = os.path.join(tmp_path, 'unordered.f16')
+    with open(raw_path, 'wb') as f:
+        chunk = []
+        for paper in retrieve_paper([category]):
+            chunk.append(paper)
+            if len(chunk) < chunk_size:
+                continue
+            dimension = write_chunk(f, embeddings, chunk)
+            ids += [paper['id'] for paper in chunk]
+            chunk = []
+            print(f"{category}: embedded {len(ids)} papers")
+        if len(chunk) > 0:
+            dimension = write_chunk(f, embeddings, chunk)
+            ids += [paper['id'] for paper in chunk]
+    if len(ids) == 0:
+        shutil.rmtree(tmp_path)
+        raise ValueError(f"no papers of {category} in the corpus")
+    vectors = np.memmap(raw_path, dtype=np.float16, mode='r', shape=(len(ids), dimension))
+
+    # train the inverted lists on a sample, then store the rows grouped by list
+    nlist = min(nlist or max(1, int(np.sqrt(len(ids)))), len(ids))
+    rng = np.random.default_rng(0)
+    sample_size = min(len(ids), nlist * KMEANS_SAMPLE_RATIO)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(ids), sample_size, replace=False))], dtype=np.float32)
+    centroids = train_centroids(sample, nlist)
+    assignment = assign(vectors, centroids)
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+    ordered = np.memmap(os.path.join(tmp_path, 'vectors.f16'), dtype=np.float16, mode='w+', shape=(len(ids), dimension))
+    for start in range(0, len(ids), chunk_size):
+        ordered[start:start + chunk_size] = vectors[order[start:start + chunk_size]]
+    ordered.flush()
+    del ordered, vectors
+    os.remove(raw_path)
+    np.save(os.path.join(tmp_path, 'ids.npy'), np.array(ids)[order])
+    np.save(os.path.join(tmp_path, 'centroids.npy'), centroids)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    meta = {
+        'category': category,
+        'model': model_name,
+        'count': len(ids),
+        'dimension': dimension,
+        'nlist': nlist
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # swap the new index in at once
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    with _indexes_lock:
+        _indexes.pop(path, None)
+    return meta
+
+
+def write_chunk(f, embeddings, papers: list):
+    vectors = normalize(np.asarray(embeddings.embed_documents([paper['abstract'] for paper in papers]), dtype=np.float32))
+    vectors.astype(np.float16).tofile(f)
+    return vectors.shape[1]
+
+
+class CorpusIndex:
+    """
+    read-only IVF index of one category, memory-mapped from the files written by `build_corpus_index`
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.vectors = np.memmap(os.path.join(path, 'vectors.f16'), dtype=np.float16, mode='r',
+                                 shape=(self.meta['count'], self.meta['dimension']))
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    def search(self, vector, k: int = 10, nprobe: int = CORPUS_INDEX_NPROBE):
+        """
+        ## return
+        list of (arxiv id, cosine similarity), best first
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[idx], self.offsets[idx + 1]) for idx in lists])
+        if len(rows) == 0:
+            return []
+        rows.sort()
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(str(self.ids[rows[idx]]), float(scores[idx])) for idx in top]
+
+
+def get_corpus_index(category: str, index_dir: str = CORPUS_INDEX_DIR):
+    """
+    return the shared `CorpusIndex` of `category`, or `None` if it was never built
+    """
+    path = os.path.join(index_dir, category)
+    with _indexes_lock:
+        if path not in _indexes:
+            if not os.path.isfile(os.path.join(path, 'meta.json')):
+                return None
+            _indexes[path] = CorpusIndex(path)
+        return _indexes[path]
+
+
+def search_categories(query: str, categories: list, embeddings, k: int = 10, exclude: set = None):
+    """
+    nearest papers to `query` among the built indexes of `categories`, as documents of type 'category'.
+    indexes built with another embeddings model than `embeddings` are skipped.
+    """
+    model_name = getattr(embeddings, 'model_name', None)
+    indexes = []
+    for category in categories:
+        index = get_corpus_index(category) if category in category_map else None
+        if index is not None and index.meta['model'] == model_name:
+            indexes.append(index)
+    if len(indexes) == 0:
+        return []
+    vector = embeddings.embed_query(query)
+    exclude = exclude or set()
+    best = {}
+    for index in indexes:
+        for arxiv_id, score in index.search(vector, k=k + len(exclude)):
+            if arxiv_id not in exclude:
+                best[arxiv_id] = max(score, best.get(arxiv_id, score))
+    top = sorted(best, key=lambda arxiv_id: -best[arxiv_id])[:k]
+    papers = get_corpus().get_papers(top)
+    documents = []
+    for arxiv_id in top:
+        paper = papers.get(arxiv_id)
+        if paper is None:
+            continue
+        documents.append(Document(
+            page_content=paper['abstract'],
+            metadata={'title': paper['title'],
+                      'year': paper['year'],
+                      'url': f"https://arxiv.org/abs/{arxiv_id}",
+                      'arxivId': arxiv_id,
+                      'type': 'category'}
+        ))
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the vector index of arXiv categories")
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('categories', nargs='+')
+    parser.add_argument('--nlist', type=int, help="number of inverted lists")
+    args = parser.parse_args()
+    for category in args.categories:
+        print(build_corpus_index(category, nlist=args.nlist))
+
+
+if __name__ == '__main__':
+    main()
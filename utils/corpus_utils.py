@@ -0,0 +1,249 @@
+"""
+indexed on-disk corpus of the arXiv metadata dumps in `./arxiv/category/{name}.jsonl`.
+
+build (or refresh) the corpus of some categories from the repository root:
+    python -m utils.corpus_utils build cs.LG cs.CL
+and query it:
+    python -m utils.corpus_utils search cs.CL --query "retrieval augmented generation"
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from utils.category_list import category_map
+
+CORPUS_DIR = os.getenv('ARXIV_CORPUS_DIR', './arxiv/category')
+CORPUS_DB_PATH = os.getenv('ARXIV_CORPUS_DB_PATH', './arxiv/corpus.sqlite3')
+BUILD_BATCH_SIZE = 10000
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def category_path(category: str, source_dir: str = CORPUS_DIR):
+    return os.path.join(source_dir, f"{category}.jsonl")
+
+
+def validate_categories(categories: list):
+    unknown = [category for category in categories if category not in category_map]
+    if len(unknown) > 0:
+        raise ValueError(f"unknown arxiv categories: {', '.join(unknown)}")
+
+
+def iter_jsonl(path: str):
+    """
+    stream the records of a metadata dump one line at a time
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def record_to_paper(data: dict):
+    return {
+        'id': data['id'],
+        'title': data['title'],
+        'abstract': data['abstract'],
+        'year': data['update_date'].split('-')[0]
+    }
+
+
+def match_expression(query: str):
+    """
+    FTS5 expression matching any term of `query`, with every term quoted so that user input is never parsed as syntax
+    """
+    return " OR ".join(f'"{token}"' for token in TOKEN_PATTERN.findall(query.lower()))
+
+
+class ArxivCorpus:
+    """
+    SQLite corpus of arXiv papers with an FTS5 index over titles and abstracts.
+    papers are keyed by arxiv id and linked to every category of `category_map` they are listed in;
+    each built dump is recorded with its size and mtime so that unchanged dumps are skipped on rebuild.
+    """
+
+    def __init__(self, path: str = CORPUS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS papers (rowid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                "title TEXT, abstract TEXT, year TEXT)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS paper_categories (category TEXT NOT NULL, paper_rowid INTEGER NOT NULL, "
+                "PRIMARY KEY (category, paper_rowid)) WITHOUT ROWID")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS dumps (category TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, count INTEGER NOT NULL, built_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(title, abstract, "
+                "content='papers', content_rowid='rowid')")
+            # keep the external-content FTS index in sync with `papers`
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS papers_insert AFTER INSERT ON papers BEGIN "
+                "INSERT INTO papers_fts (rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract); END")
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS papers_update AFTER UPDATE ON papers BEGIN "
+                "INSERT INTO papers_fts (papers_fts, rowid, title, abstract) VALUES ('delete', old.rowid, old.title, old.abstract); "
+                "INSERT INTO papers_fts (rowid, title, abstract) VALUES (new.rowid, new.title, new.abstract); END")
+            self._conn.commit()
+
+    def built_categories(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT category FROM dumps")}
+
+    def build(self, categories: list, source_dir: str = CORPUS_DIR, batch_size: int = BUILD_BATCH_SIZE, force=False):
+        """
+        stream the dumps of `categories` into the corpus, `batch_size` records per transaction
+        ## return
+        dict of category -> number of records read (`None` for dumps skipped as unchanged)
+        """
+        validate_categories(categories)
+        counts = {}
+        for category in categories:
+            path = category_path(category, source_dir)
+            stat = os.stat(path)
+            with self._lock:
+                row = self._conn.execute("SELECT size, mtime FROM dumps WHERE category = ?", (category,)).fetchone()
+            if not force and row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                counts[category] = None
+                continue
+            count = 0
+            batch = []
+            for data in iter_jsonl(path):
+                batch.append(data)
+                if len(batch) >= batch_size:
+                    self._insert(category, batch)
+                    count += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                self._insert(category, batch)
+                count += len(batch)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO dumps (category, size, mtime, count, built_at) VALUES (?, ?, ?, ?, ?)",
+                    (category, stat.st_size, stat.st_mtime, count, time.time()))
+                self._conn.commit()
+            counts[category] = count
+        return counts
+
+    def _insert(self, category: str, records: list):
+        papers = [record_to_paper(data) for data in records]
+        links = []
+        for data in records:
+            listed = set((data.get('categories') or '').split()) & set(category_map)
+            links += [(listed_category, data['id']) for listed_category in listed | {category}]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO papers (id, title, abstract, year) VALUES (:id, :title, :abstract, :year) "
+                "ON CONFLICT (id) DO UPDATE SET title = excluded.title, abstract = excluded.abstract, year = excluded.year "
+                "WHERE title IS NOT excluded.title OR abstract IS NOT excluded.abstract OR year IS NOT excluded.year",
+                papers)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO paper_categories (category, paper_rowid) "
+                "SELECT ?, rowid FROM papers WHERE id = ?", links)
+            self._conn.commit()
+
+    def iter_papers(self, categories: list, query: str = None, min_year: int = None, limit: int = None,
+                    fetch_size: int = 1000):
+        """
+        lazily yield the papers of `categories` (each paper once), `fetch_size` rows at a time.
+        with `query`, only papers matching one of its terms are yielded, best BM25 match first.
+        ## return
+        generator of dicts with `id`, `title`, `abstract` and `year`, as in `record_to_paper`
+        """
+        validate_categories(categories)
+        placeholders = ", ".join("?" for _ in categories)
+        sql = ("SELECT p.id, p.title, p.abstract, p.year FROM papers p "
+               f"WHERE p.rowid IN (SELECT paper_rowid FROM paper_categories WHERE category IN ({placeholders}))")
+        args = list(categories)
+        if query is not None:
+            expression = match_expression(query)
+            if not expression:
+                return
+            sql = ("SELECT p.id, p.title, p.abstract, p.year FROM papers_fts JOIN papers p ON p.rowid = papers_fts.rowid "
+                   f"WHERE papers_fts MATCH ? AND p.rowid IN (SELECT paper_rowid FROM paper_categories WHERE category IN ({placeholders}))")
+            args = [expression] + args
+        if min_year is not None:
+            sql += " AND CAST(p.year AS INTEGER) >= ?"
+            args.append(min_year)
+        if query is not None:
+            sql += " ORDER BY bm25(papers_fts)"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        # a reader connection per iteration, so that a paused generator never holds the writer's lock
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if len(rows) == 0:
+                    return
+                for row in rows:
+                    yield {'id': row[0], 'title': row[1], 'abstract': row[2], 'year': row[3]}
+        finally:
+            conn.close()
+
+    def get_papers(self, ids: list):
+        """
+        return a dict of arxiv id -> paper for the `ids` found in the corpus
+        """
+        papers = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, title, abstract, year FROM papers WHERE id IN ({placeholders})", chunk).fetchall()
+            for row in rows:
+                papers[row[0]] = {'id': row[0], 'title': row[1], 'abstract': row[2], 'year': row[3]}
+        return papers
+
+
+_corpus = None
+_corpus_lock = threading.Lock()
+
+
+def get_corpus(path: str = CORPUS_DB_PATH):
+    """
+    return the shared `ArxivCorpus`, opened on first use
+    """
+    global _corpus
+    with _corpus_lock:
+        if _corpus is None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            _corpus = ArxivCorpus(path)
+        return _corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build or query the arXiv category corpus")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="index the metadata dumps of categories")
+    build_parser.add_argument('categories', nargs='+')
+    build_parser.add_argument('--source', default=CORPUS_DIR, help="directory of the {category}.jsonl dumps")
+    build_parser.add_argument('--force', action='store_true', help="reindex dumps that did not change")
+    search_parser = subparsers.add_parser('search', help="query the corpus")
+    search_parser.add_argument('categories', nargs='+')
+    search_parser.add_argument('--query')
+    search_parser.add_argument('--min-year', type=int)
+    search_parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    corpus = get_corpus()
+    if args.command == 'build':
+        for category, count in corpus.build(args.categories, source_dir=args.source, force=args.force).items():
+            print(f"{category}: {'unchanged' if count is None else f'{count} records'}")
+    else:
+        for paper in corpus.iter_papers(args.categories, query=args.query, min_year=args.min_year, limit=args.limit):
+            print(f"{paper['id']}\t{paper['year']}\t{paper['title']}")
+
+
+if __name__ == '__main__':
+    main()
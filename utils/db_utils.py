@@ -1,49 +1,265 @@
-from dotenv import find_dotenv, load_dotenv
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import hashlib
+import numpy as np
 import os
+import re
+import threading
+import time
+import chromadb
+import openai
+from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
 from uuid import uuid4
+from utils.cache_utils import EmbeddingCache
+from utils.concurrency_utils import KeyedLocks
+from utils.metrics_utils import upstream_call
+from utils.rate_limit_utils import MAX_RETRIES, backoff_seconds, error_retry_after, error_status, get_limiter
+from utils.semantic_scholar_utils import SpecterEmbeddings
+from utils.settings_utils import HTTP_READ_TIMEOUT
 
 # __import__('pysqlite3')
 # import sys
 # sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 from langchain_chroma import Chroma
-import chromadb.api
 
 
-def get_embeddings(name="openai", api_key="Your-Api-Key"):
-    load_dotenv(find_dotenv())
+embedding_cache = EmbeddingCache(
+    name='embeddings',
+    max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 200000))
+)
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 50000))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 512))
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', 4))
+# transient errors of the OpenAI client retried by `BatchedEmbeddings`, besides 429 and 5xx responses
+TIMEOUT_ERRORS = (openai.APITimeoutError, openai.APIConnectionError)
+# chroma rejects larger upserts
+ADD_BATCH_SIZE = 5000
+# embeddings backend of this deployment: 'openai' or 'local'
+EMBEDDINGS_BACKEND = os.getenv('EMBEDDINGS_BACKEND', 'openai')
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+# sentence-transformers backend: 'torch', 'onnx' or 'openvino'
+LOCAL_EMBEDDING_BACKEND = os.getenv('LOCAL_EMBEDDING_BACKEND', 'torch')
+# e.g. 'onnx/model_qint8_avx2.onnx' for a quantized ONNX export
+LOCAL_EMBEDDING_FILE = os.getenv('LOCAL_EMBEDDING_FILE')
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv('LOCAL_EMBEDDING_BATCH_SIZE', 64))
+LOCAL_EMBEDDING_THREADS = int(os.getenv('LOCAL_EMBEDDING_THREADS', 2))
+
+_local_models = {}
+_local_models_lock = threading.Lock()
+collection_locks = KeyedLocks()
+# persistent Chroma collections kept open by `set_db`, by name, least recently used first
+_collections = OrderedDict()
+_collections_lock = threading.Lock()
+MAX_OPEN_COLLECTIONS = int(os.getenv('MAX_OPEN_COLLECTIONS', 32))
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    embeddings wrapper that splits texts into token-budgeted batches and embeds several batches concurrently,
+    paced by the limiter of the provider's host. a failed batch is retried on its own.
+    ## args
+    - embeddings: wrapped embeddings
+    - host: host of the provider, for `get_limiter`
+    - max_tokens: token budget of a batch
+    - max_texts: maximum number of texts in a batch
+    - max_workers: number of batches embedded at the same time
+    """
+
+    def __init__(self, embeddings, host: str = None, max_tokens: int = EMBEDDING_BATCH_TOKENS,
+                 max_texts: int = EMBEDDING_BATCH_SIZE, max_workers: int = EMBEDDING_CONCURRENCY):
+        self.embeddings = embeddings
+        self.host = host
+        self.limiter = get_limiter(host) if host is not None else None
+        self.max_tokens = max_tokens
+        self.max_texts = max_texts
+        self.max_workers = max_workers
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            self._encoding = None
+
+    def count_tokens(self, text: str):
+        if self._encoding is None:
+            return len(text) // 4 + 1
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def make_batches(self, texts):
+        batches = []
+        batch = []
+        tokens = 0
+        for text in texts:
+            count = self.count_tokens(text)
+            if len(batch) > 0 and (tokens + count > self.max_tokens or len(batch) >= self.max_texts):
+                batches.append(batch)
+                batch = []
+                tokens = 0
+            batch.append(text)
+            tokens += count
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _embed_batch(self, batch):
+        if self.limiter is None:
+            return self.embeddings.embed_documents(batch)
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                with upstream_call(self.host):
+                    return self.embeddings.embed_documents(batch)
+            except Exception as e:
+                status = error_status(e)
+                retryable = status == 429 or (status is not None and status >= 500) or isinstance(e, TIMEOUT_ERRORS)
+                if not retryable or attempt == MAX_RETRIES:
+                    raise
+                print(f"embedding batch of {len(batch)} failed ({e}), retrying")
+                wait = error_retry_after(e)
+                if status == 429:
+                    # only a rate limit slows down the other batches of the provider
+                    self.limiter.penalize(wait if wait is not None else backoff_seconds(attempt))
+                else:
+                    time.sleep(wait if wait is not None else backoff_seconds(attempt))
+
+    def embed_documents(self, texts):
+        batches = self.make_batches(texts)
+        if len(batches) <= 1:
+            return [vector for batch in batches for vector in self._embed_batch(batch)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return [vector for vectors in pool.map(self._embed_batch, batches) for vector in vectors]
+
+    def embed_query(self, text):
+        if self.limiter is None:
+            return self.embeddings.embed_query(text)
+        self.limiter.acquire()
+        with upstream_call(self.host):
+            return self.embeddings.embed_query(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    embeddings wrapper that serves vectors from `embedding_cache`, keyed by a hash of (model name, text).
+    only the texts missing from the cache are sent to the wrapped embeddings, in one batch.
+    """
+
+    def __init__(self, embeddings, model_name: str, cache: EmbeddingCache = embedding_cache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+
+    def _key(self, text: str, kind: str = 'document'):
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode('utf-8')).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if len(missing) > 0:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), new_vectors))
+            self.cache.set_many(new_vectors)
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text, kind='query')
+        vectors = self.cache.get_many([key])
+        if key not in vectors:
+            vectors[key] = self.embeddings.embed_query(text)
+            self.cache.set_many(vectors)
+        return vectors[key]
+
+
+def get_local_model(model_name: str = LOCAL_EMBEDDING_MODEL):
+    """
+    return the sentence-transformer embeddings of `model_name`, loaded once and kept warm across requests
+    """
+    from langchain_huggingface import HuggingFaceEmbeddings
+    with _local_models_lock:
+        if model_name not in _local_models:
+            model_kwargs = {'device': 'cpu'}
+            if LOCAL_EMBEDDING_BACKEND != 'torch':
+                model_kwargs['backend'] = LOCAL_EMBEDDING_BACKEND
+            if LOCAL_EMBEDDING_FILE:
+                model_kwargs['model_kwargs'] = {'file_name': LOCAL_EMBEDDING_FILE}
+            _local_models[model_name] = HuggingFaceEmbeddings(
+                model_name=model_name,
+                model_kwargs=model_kwargs,
+                encode_kwargs={'batch_size': LOCAL_EMBEDDING_BATCH_SIZE, 'normalize_embeddings': True}
+            )
+        return _local_models[model_name]
+
+
+def get_embeddings(name=None, api_key="Your-Api-Key", cache=True):
+    if name is None:
+        name = EMBEDDINGS_BACKEND
     if name == "openai":
         os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
-        embeddings = OpenAIEmbeddings(api_key=api_key)
+        # retries are left to `BatchedEmbeddings`, which paces them with the shared limiter
+        embeddings = OpenAIEmbeddings(api_key=api_key, timeout=HTTP_READ_TIMEOUT, max_retries=0)
+        model_name = f"openai/{embeddings.model}"
+        embeddings = BatchedEmbeddings(embeddings, host='api.openai.com')
+    elif name == "local":
+        embeddings = get_local_model()
+        model_name = f"local/{LOCAL_EMBEDDING_MODEL}/{LOCAL_EMBEDDING_BACKEND}/{LOCAL_EMBEDDING_FILE}"
+        # the texts of a request are encoded in several batches on a small thread pool
+        embeddings = BatchedEmbeddings(embeddings, max_texts=LOCAL_EMBEDDING_BATCH_SIZE * 4,
+                                       max_workers=LOCAL_EMBEDDING_THREADS)
+    elif name == "specter":
+        # the model API is already batched and paced by `semantic_scholar_utils.get_embeddings`
+        embeddings = SpecterEmbeddings()
+        model_name = "semantic_scholar/specter_v1"
     else:
         raise Exception(f'{name} is not currently supported as embeddings')
+    if cache:
+        embeddings = CachedEmbeddings(embeddings, model_name=model_name)
     return embeddings
 
 
 def load_db(name: str, embeddings):
     persist_directory = f"./db/{name}"
     if os.path.isdir(persist_directory):
-        return Chroma(
-            collection_name=name,
-            embedding_function=embeddings,
-            persist_directory=persist_directory,
-        )
+        return set_db(name=name, embeddings=embeddings, save_local=True)
     else:
         raise Exception(f"db named {name} does not exist.")
 
 
 def set_db(name: str, embeddings, save_local=True):
+    """
+    a persistent collection is opened once per process and shared by every request:
+    separate `Chroma` instances on the same directory keep separate in-memory HNSW indexes,
+    so readers of one would rank against a stale index after another one wrote.
+    the shared instance keeps the `embeddings` it was opened with.
+    at most `MAX_OPEN_COLLECTIONS` collections stay open; the least recently used ones are closed.
+    """
     if save_local:
-        if not os.path.isdir('./db'):
-            os.mkdir('./db')
-        chromadb.api.client.SharedSystemClient.clear_system_cache()
-        vector_db = Chroma(
-            collection_name=name,
-            embedding_function=embeddings,
-            persist_directory=f"./db/{name}"
-        )
-        return vector_db
+        evicted = []
+        with collection_locks.lock(name):
+            with _collections_lock:
+                entry = _collections.get(name)
+                if entry is not None:
+                    _collections.move_to_end(name)
+            if entry is None:
+                os.makedirs('./db', exist_ok=True)
+                client = chromadb.PersistentClient(path=f"./db/{name}")
+                entry = (client, Chroma(
+                    collection_name=name,
+                    embedding_function=embeddings,
+                    client=client
+                ))
+                with _collections_lock:
+                    _collections[name] = entry
+                    while len(_collections) > MAX_OPEN_COLLECTIONS:
+                        evicted.append(_collections.popitem(last=False))
+        # outside the lock of `name`, so that only one collection lock is held at a time
+        close_collections(evicted)
+        return entry[1]
     else:
         vector_db = Chroma(
             collection_name=name,
@@ -52,7 +268,145 @@ def set_db(name: str, embeddings, save_local=True):
         return vector_db
 
 
+def close_collections(collections):
+    """
+    close the clients of `(name, (client, db))` pairs evicted by `set_db`, each once no request is writing to it.
+    the clients of one directory share their resources, which are released when the last of them is closed
+    """
+    for name, (client, db) in collections:
+        with collection_locks.lock(name):
+            client.close()
+
+
+class InMemoryIndex:
+    """
+    ephemeral vector index backed by a normalized NumPy matrix (one matmul + `argpartition` per query).
+    implements the part of the Chroma interface used by this server; scores are cosine distances.
+    documents carrying a precomputed vector in `metadata['embedding']` (e.g. SPECTER vectors of the Graph API)
+    are added as they are, and only the others are embedded, from the text given by `document_text`.
+    """
+
+    def __init__(self, embeddings, document_text=None):
+        self.embeddings = embeddings
+        self.document_text = document_text or (lambda document: document.page_content)
+        self.ids = []
+        self.documents = []
+        self.matrix = None
+
+    def add_documents(self, documents, ids=None):
+        if ids is None:
+            ids = [str(uuid4()) for _ in range(len(documents))]
+        if len(documents) > 0:
+            # documents may be shared with coalesced requests, so their metadata is left untouched
+            vectors = [document.metadata.get('embedding') for document in documents]
+            missing = [idx for idx, vector in enumerate(vectors) if vector is None]
+            if len(missing) > 0:
+                new_vectors = self.embeddings.embed_documents([self.document_text(documents[idx]) for idx in missing])
+                for idx, vector in zip(missing, new_vectors):
+                    vectors[idx] = vector
+            self.add_embeddings(documents, vectors, ids)
+        return ids
+
+    def add_embeddings(self, documents, vectors, ids):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self.matrix = vectors if self.matrix is None else np.vstack([self.matrix, vectors])
+        self.documents.extend(documents)
+        self.ids.extend(ids)
+
+    def get(self, include=None):
+        return {'ids': list(self.ids)}
+
+    def delete(self, ids):
+        removed = set(ids)
+        keep = [idx for idx, key in enumerate(self.ids) if key not in removed]
+        self.ids = [self.ids[idx] for idx in keep]
+        self.documents = [self.documents[idx] for idx in keep]
+        self.matrix = self.matrix[keep] if len(keep) > 0 else None
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4):
+        if self.matrix is None:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        scores = self.matrix @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[idx], float(1.0 - scores[idx])) for idx in top]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.similarity_search_by_vector_with_score(self.embeddings.embed_query(query), k=k)
+
+
+def index_lock(db, name: str):
+    """
+    lock serializing the mutations of the persistent collection `name` across requests;
+    an `InMemoryIndex` belongs to a single request and needs none
+    """
+    if isinstance(db, InMemoryIndex):
+        return nullcontext()
+    # the lock `set_db` holds while opening and closing the collection
+    return collection_locks.lock(collection_name(name, db.embeddings))
+
+
+def collection_name(name: str, embeddings):
+    """
+    name of the persistent collection `name` for the model of `embeddings` (see `CachedEmbeddings.model_name`),
+    so that switching models never reuses a collection of vectors of another model and dimension
+    """
+    model_name = getattr(embeddings, 'model_name', None)
+    if model_name is None:
+        return name
+    return f"{name}__{re.sub(r'[^A-Za-z0-9._-]+', '_', model_name).strip('._-')}"
+
+
+def open_index(name: str, embeddings, persist=True, document_text=None):
+    """
+    persistent Chroma collection (one per model, see `collection_name`),
+    or an ephemeral `InMemoryIndex` for collections that are queried only once
+    """
+    if persist:
+        return set_db(name=collection_name(name, embeddings), embeddings=embeddings, save_local=True)
+    return InMemoryIndex(embeddings, document_text=document_text)
+
+
 def add_documents(db, documents):
     uuids = [str(uuid4()) for _ in range(len(documents))]
-    db.add_documents(documents=documents, ids=uuids)
+    for start in range(0, len(documents), ADD_BATCH_SIZE):
+        db.add_documents(documents=documents[start:start + ADD_BATCH_SIZE], ids=uuids[start:start + ADD_BATCH_SIZE])
     return db
+
+
+def document_key(document):
+    """
+    stable id of a document: Semantic Scholar paperId, arxiv id, or url
+    """
+    metadata = document.metadata
+    if metadata.get('paperId'):
+        return metadata['paperId']
+    if metadata.get('arxivId'):
+        return f"ARXIV:{metadata['arxivId']}"
+    return metadata['url']
+
+
+def sync_documents(db, documents, evict=True):
+    """
+    incrementally update `db` so that it holds `documents`.
+    only documents that are not stored yet are embedded, and (if `evict`) stored documents
+    that are no longer in `documents` are deleted.
+    ## return
+    (db, number of added documents, number of evicted documents)
+    """
+    incoming = {}
+    for document in documents:
+        incoming.setdefault(document_key(document), document)
+    stored = set(db.get(include=[])['ids'])
+    new_ids = [key for key in incoming if key not in stored]
+    for start in range(0, len(new_ids), ADD_BATCH_SIZE):
+        chunk = new_ids[start:start + ADD_BATCH_SIZE]
+        db.add_documents(documents=[incoming[key] for key in chunk], ids=chunk)
+    stale_ids = [key for key in stored if key not in incoming] if evict else []
+    if len(stale_ids) > 0:
+        db.delete(ids=stale_ids)
+    return db, len(new_ids), len(stale_ids)
@@ -0,0 +1,117 @@
+import heapq
+import os
+import time
+from langchain_core.documents import Document
+from utils.semantic_scholar_utils import fetch_paper_graph, get_papers_batch, graph_store
+
+EXPANSION_MAX_CALLS = int(os.getenv('EXPANSION_MAX_CALLS', 10))
+EXPANSION_MAX_SECONDS = float(os.getenv('EXPANSION_MAX_SECONDS', 20))
+EXPANSION_MAX_PAPERS = int(os.getenv('EXPANSION_MAX_PAPERS', 3000))
+EXPANSION_BATCH_SIZE = int(os.getenv('EXPANSION_BATCH_SIZE', 20))
+MAX_HOPS = 3
+
+NEIGHBOR_FIELDS = ['paperId', 'title', 'abstract', 'year', 'url', 'citationCount']
+# type of the documents found through each endpoint, as in `references_to_documents`/`citations_to_documents`
+DOCUMENT_TYPE = {'references': 'citation', 'citations': 'cited paper'}
+
+
+def priority(paper: dict, is_influential=None):
+    """
+    heap key of a frontier node: influential edges first, then highly cited papers
+    """
+    return (-int(bool(is_influential)), -(paper.get('citationCount') or 0))
+
+
+def paper_to_document(paper: dict, endpoint: str, hop: int):
+    if paper.get('abstract') is None or paper.get('url') is None or paper.get('year') is None:
+        return None
+    return Document(
+        page_content=paper['abstract'],
+        metadata={'title': paper['title'],
+                  'year': paper['year'],
+                  'url': paper['url'],
+                  'paperId': paper['paperId'],
+                  'type': DOCUMENT_TYPE[endpoint],
+                  'hop': hop}
+    )
+
+
+def expand_citation_graph(arxiv_id: str, hops: int = 2, max_calls: int = EXPANSION_MAX_CALLS,
+                          max_seconds: float = EXPANSION_MAX_SECONDS, max_papers: int = EXPANSION_MAX_PAPERS,
+                          batch_size: int = EXPANSION_BATCH_SIZE):
+    """
+    walk up to `hops` hops of references and citations out of the paper.
+    the frontier is expanded best-first (`priority`) in batches of `batch_size` papers per `/paper/batch` call,
+    with one visited set shared by both directions, until the call, time or paper budget runs out.
+    the first hop is always kept whole, and the paper budget only applies to the hops beyond it.
+    ## args
+    - arxiv_id: arxiv number of the seed paper
+    - hops: number of hops (at most `MAX_HOPS`)
+    - max_calls: budget of Semantic Scholar calls spent beyond the first hop
+    - max_seconds: wall-time budget
+    - max_papers: maximum number of papers visited beyond the first hop
+    ## return
+    (documents, stats)
+    """
+    start = time.time()
+    hops = min(hops, MAX_HOPS)
+    documents = []
+    visited = set()
+    frontier = []
+    for endpoint in ('references', 'citations'):
+        response_data = fetch_paper_graph(arxiv_id, endpoint)
+        if response_data is None:
+            continue
+        side = 'citedPaper' if endpoint == 'references' else 'citingPaper'
+        for item in response_data['data']:
+            paper = item[side]
+            if paper.get('paperId') is None or paper['paperId'] in visited:
+                continue
+            visited.add(paper['paperId'])
+            document = paper_to_document(paper, endpoint, hop=1)
+            if document is not None:
+                documents.append(document)
+            heapq.heappush(frontier, (priority(paper, item.get('isInfluential')), paper['paperId'], 1))
+
+    # a popular seed alone can have more neighbours than `max_papers`, which must not leave no budget for expansion
+    first_hop = len(visited)
+    fields = ['paperId', 'citationCount', 'referenceCount'] + [
+        f"{endpoint}.{field}" for endpoint in ('references', 'citations') for field in NEIGHBOR_FIELDS]
+    calls = 0
+    while (len(frontier) > 0 and calls < max_calls and len(visited) - first_hop < max_papers
+           and time.time() - start < max_seconds):
+        batch = []
+        while len(frontier) > 0 and len(batch) < batch_size:
+            _, paper_id, hop = heapq.heappop(frontier)
+            if hop < hops:
+                batch.append((paper_id, hop))
+        if len(batch) == 0:
+            break
+        papers = get_papers_batch([paper_id for paper_id, _ in batch], fields=','.join(fields))
+        calls += 1
+        for (paper_id, hop), paper in zip(batch, papers):
+            if paper is None:
+                continue
+            for endpoint in ('references', 'citations'):
+                neighbors = [neighbor for neighbor in paper.get(endpoint) or [] if neighbor.get('paperId') is not None]
+                side = 'citedPaper' if endpoint == 'references' else 'citingPaper'
+                # nested lists may be truncated, so their edges are only added to the stored neighbourhood
+                graph_store.store_neighborhood(paper_id, endpoint, [{side: neighbor} for neighbor in neighbors],
+                                               replace=False)
+                for neighbor in neighbors:
+                    if neighbor['paperId'] in visited or len(visited) - first_hop >= max_papers:
+                        continue
+                    visited.add(neighbor['paperId'])
+                    document = paper_to_document(neighbor, endpoint, hop=hop + 1)
+                    if document is not None:
+                        documents.append(document)
+                    heapq.heappush(frontier, (priority(neighbor), neighbor['paperId'], hop + 1))
+
+    stats = {
+        'hops': hops,
+        'calls': calls,
+        'visited': len(visited),
+        'documents': len(documents),
+        'seconds': time.time() - start
+    }
+    return documents, stats
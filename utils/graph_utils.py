@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+# fields of a paper kept in the store, as named by the Semantic Scholar Graph API
+PAPER_FIELDS = ['paperId', 'title', 'abstract', 'year', 'url', 'citationCount', 'referenceCount']
+# key of the neighbour in the items of each endpoint
+NEIGHBOR_KEY = {'references': 'citedPaper', 'citations': 'citingPaper'}
+OPPOSITE_ENDPOINT = {'references': 'citations', 'citations': 'references'}
+
+
+class GraphStore:
+    """
+    local citation graph (SQLite adjacency tables) filled from Semantic Scholar responses.
+    a paper's neighbourhood is stored together with the citation/reference count it was fetched at,
+    so that it only needs to be refetched when that count changes.
+    """
+
+    def __init__(self, path: str = './graph.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS papers (paper_id TEXT PRIMARY KEY, arxiv_id TEXT, title TEXT, abstract TEXT, "
+                "year INTEGER, url TEXT, citation_count INTEGER, reference_count INTEGER, updated_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS papers_arxiv_id ON papers (arxiv_id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS edges (citing_id TEXT NOT NULL, cited_id TEXT NOT NULL, "
+                "is_influential INTEGER, PRIMARY KEY (citing_id, cited_id))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS edges_cited_id ON edges (cited_id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS neighborhoods (paper_id TEXT NOT NULL, endpoint TEXT NOT NULL, "
+                "count INTEGER, fetched_at REAL NOT NULL, PRIMARY KEY (paper_id, endpoint))")
+            self._conn.commit()
+
+    def upsert_papers(self, papers: list, arxiv_id: str = None):
+        """
+        insert or update papers given as Graph API dicts; missing fields keep their stored value
+        """
+        now = time.time()
+        rows = [(paper['paperId'], arxiv_id, paper.get('title'), paper.get('abstract'), paper.get('year'),
+                 paper.get('url'), paper.get('citationCount'), paper.get('referenceCount'), now)
+                for paper in papers if paper.get('paperId') is not None]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO papers (paper_id, arxiv_id, title, abstract, year, url, citation_count, reference_count, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (paper_id) DO UPDATE SET "
+                "arxiv_id = COALESCE(excluded.arxiv_id, arxiv_id), title = COALESCE(excluded.title, title), "
+                "abstract = COALESCE(excluded.abstract, abstract), year = COALESCE(excluded.year, year), "
+                "url = COALESCE(excluded.url, url), citation_count = COALESCE(excluded.citation_count, citation_count), "
+                "reference_count = COALESCE(excluded.reference_count, reference_count), updated_at = excluded.updated_at",
+                rows)
+            self._conn.commit()
+
+    def store_neighborhood(self, paper_id: str, endpoint: str, items: list, count: int = None, replace=True):
+        """
+        replace the `references` or `citations` of `paper_id` with the items of a Graph API response.
+        with `replace=False` the edges are only added, and the neighbourhood is not recorded as complete.
+        """
+        side = NEIGHBOR_KEY[endpoint]
+        neighbors = [item[side] for item in items if item[side].get('paperId') is not None]
+        self.upsert_papers(neighbors)
+        if endpoint == 'references':
+            edges = [(paper_id, item[side]['paperId'], item.get('isInfluential'))
+                     for item in items if item[side].get('paperId') is not None]
+        else:
+            edges = [(item[side]['paperId'], paper_id, item.get('isInfluential'))
+                     for item in items if item[side].get('paperId') is not None]
+        with self._lock:
+            if replace:
+                own, other = ('citing_id', 'cited_id') if endpoint == 'references' else ('cited_id', 'citing_id')
+                kept = {edge[1] if endpoint == 'references' else edge[0] for edge in edges}
+                removed = [row[0] for row in self._conn.execute(f"SELECT {other} FROM edges WHERE {own} = ?", (paper_id,))
+                           if row[0] not in kept]
+                # a removed edge also belonged to the neighbourhood of the paper on its other side,
+                # which can no longer be served as complete
+                self._conn.executemany(
+                    "DELETE FROM neighborhoods WHERE paper_id = ? AND endpoint = ?",
+                    [(neighbor_id, OPPOSITE_ENDPOINT[endpoint]) for neighbor_id in removed])
+                self._conn.execute(f"DELETE FROM edges WHERE {own} = ?", (paper_id,))
+            insert = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+            self._conn.executemany(
+                f"{insert} INTO edges (citing_id, cited_id, is_influential) VALUES (?, ?, ?)", edges)
+            if replace:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO neighborhoods (paper_id, endpoint, count, fetched_at) VALUES (?, ?, ?, ?)",
+                    (paper_id, endpoint, count, time.time()))
+            self._conn.commit()
+
+    def get_neighborhood_count(self, paper_id: str, endpoint: str):
+        """
+        return the count the neighbourhood was stored at, or `None` if it was never stored
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT count FROM neighborhoods WHERE paper_id = ? AND endpoint = ?", (paper_id, endpoint)).fetchone()
+        return None if row is None else row[0]
+
+    def load_neighborhood(self, paper_id: str, endpoint: str):
+        """
+        return the stored neighbourhood in the format of a Graph API response (`{'data': [...]}`)
+        """
+        side = NEIGHBOR_KEY[endpoint]
+        if endpoint == 'references':
+            join, where = "e.cited_id", "e.citing_id"
+        else:
+            join, where = "e.citing_id", "e.cited_id"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT p.paper_id, p.title, p.abstract, p.year, p.url, p.citation_count, p.reference_count, e.is_influential "
+                f"FROM edges e JOIN papers p ON p.paper_id = {join} WHERE {where} = ?", (paper_id,)).fetchall()
+        data = []
+        for row in rows:
+            data.append({
+                'isInfluential': None if row[7] is None else bool(row[7]),
+                side: dict(zip(PAPER_FIELDS, row[:7]))
+            })
+        return {'data': data}
+
+    def get_paper(self, paper_id: str = None, arxiv_id: str = None):
+        with self._lock:
+            if paper_id is not None:
+                row = self._conn.execute(
+                    "SELECT paper_id, title, abstract, year, url, citation_count, reference_count FROM papers WHERE paper_id = ?",
+                    (paper_id,)).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT paper_id, title, abstract, year, url, citation_count, reference_count FROM papers WHERE arxiv_id = ?",
+                    (arxiv_id,)).fetchone()
+        return None if row is None else dict(zip(PAPER_FIELDS, row))
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from urllib.parse import urlparse
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from utils.metrics_utils import upstream_call
+from utils.settings_utils import HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class TimeoutSession(requests.Session):
+    """
+    `requests.Session` with a default (connect, read) timeout, so that a hung upstream never pins a worker.
+    every request is recorded in the upstream metrics.
+    """
+
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), pool_size: int = HTTP_POOL_SIZE):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with upstream_call(urlparse(url).hostname) as call:
+            response = super().request(method, url, **kwargs)
+            call['status'] = response.status_code
+        return response
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_async_clients = {}
+_async_clients_lock = threading.Lock()
+
+
+def get_session(host: str):
+    """
+    return the shared keep-alive session of `host`
+    """
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = TimeoutSession()
+        return _sessions[host]
+
+
+def get_async_client():
+    """
+    return the `httpx.AsyncClient` shared by the coroutines of the running event loop (HTTP/2 when `h2` is installed)
+    """
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            for other in [other for other in _async_clients if other.is_closed()]:
+                del _async_clients[other]
+            client = httpx.AsyncClient(
+                http2=HTTP2,
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE)
+            )
+            _async_clients[loop] = client
+        return client
+
+
+async def aclose_async_client():
+    """
+    close the shared client of the running event loop, e.g. on server shutdown
+    """
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+
+def read_boot_id():
+    """
+    id of the current boot of the host, so that a pid recorded before a reboot is never mistaken for a live process
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    SQLite-backed queue of background jobs executed by a local thread pool.
+    only the status, progress and result of a job are stored; its arguments (e.g. api keys) stay in memory.
+    each job records the process that owns it, so that several server processes can share the file:
+    unfinished jobs are only failed once their owner is gone.
+    ## args
+    - path: path of the SQLite file
+    - max_workers: number of jobs executed at the same time
+    - ttl: seconds finished jobs are kept
+    """
+
+    def __init__(self, path: str = './jobs.sqlite3', max_workers: int = 2, ttl: float = 60 * 60 * 24):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.boot_id = read_boot_id()
+        self._owned = set()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, "
+                "stage TEXT, progress TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if 'owner_pid' not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner_boot_id TEXT")
+            self._conn.commit()
+        self.fail_orphans()
+
+    def fail_orphans(self):
+        """
+        fail the unfinished jobs whose owning process is gone: they can not be resumed
+        since their arguments were never stored
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, owner_pid, owner_boot_id FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+            # a job recorded with this process' pid but not submitted by it belongs to an earlier process
+            # that had the same pid (e.g. pid 1 of a restarted container)
+            now = time.time()
+            orphans = [(now, job_id) for job_id, pid, boot_id in rows
+                       if pid is None or boot_id != self.boot_id or not pid_alive(pid)
+                       or (pid == os.getpid() and job_id not in self._owned)]
+            self._conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = 'interrupted by a server restart', updated_at = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')", orphans)
+            self._conn.commit()
+        return len(orphans)
+
+    def submit(self, kind: str, fn, *args, **kwargs):
+        """
+        enqueue `fn(*args, progress=..., **kwargs)` and return the id of the job.
+        `fn` reports its progress by calling `progress(stage, **info)`.
+        """
+        job_id = str(uuid4())
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                               (now - self.ttl,))
+            self._owned.add(job_id)
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, status, progress, created_at, updated_at, owner_pid, owner_boot_id) "
+                "VALUES (?, ?, 'queued', '{}', ?, ?, ?, ?)",
+                (job_id, kind, now, now, os.getpid(), self.boot_id))
+            self._conn.commit()
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id: str, fn, args, kwargs):
+        self._update(job_id, status='running')
+        stages = {}
+
+        def progress(stage: str, **info):
+            stages[stage] = {'time': time.time(), **info}
+            self._update(job_id, stage=stage, progress=json.dumps(stages))
+
+        try:
+            result = fn(*args, progress=progress, **kwargs)
+        except Exception as e:
+            print(f"job {job_id} failed: {e}")
+            self._update(job_id, status='failed', error=str(e))
+            return
+        self._update(job_id, status='done', result=json.dumps(result))
+
+    def _update(self, job_id: str, **columns):
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                               (*columns.values(), time.time(), job_id))
+            self._conn.commit()
+
+    def get(self, job_id: str):
+        """
+        return the job as a dict, or `None` if there is no such job
+        """
+        # the owner of an unfinished job may have died since it was submitted
+        self.fail_orphans()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, status, stage, progress, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'stage': row[3],
+            'progress': json.loads(row[4]),
+            'result': json.loads(row[5]) if row[5] is not None else None,
+            'error': row[6],
+            'created_at': row[7],
+            'updated_at': row[8]
+        }
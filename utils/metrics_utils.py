@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import functools
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+STAGE_SECONDS = Histogram(
+    'cite4_stage_seconds', "latency of each stage of a request", ['endpoint', 'stage'], buckets=LATENCY_BUCKETS)
+UPSTREAM_REQUESTS = Counter(
+    'cite4_upstream_requests', "calls to upstream services by host and status", ['host', 'status'])
+UPSTREAM_SECONDS = Histogram(
+    'cite4_upstream_request_seconds', "latency of calls to upstream services", ['host'], buckets=LATENCY_BUCKETS)
+DOCUMENTS = Histogram(
+    'cite4_documents', "documents per request and source", ['endpoint', 'source'], buckets=COUNT_BUCKETS)
+
+
+@contextmanager
+def span(endpoint: str, stage: str):
+    """
+    time the enclosed block as `stage` of `endpoint`
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(endpoint, stage).observe(time.perf_counter() - start)
+
+
+async def atimed(endpoint: str, stage: str, awaitable):
+    """
+    await `awaitable` inside a `span`, e.g. for the coroutines of an `asyncio.gather`
+    """
+    with span(endpoint, stage):
+        return await awaitable
+
+
+def timed(endpoint: str, stage: str = 'total'):
+    """
+    decorator timing every call of a coroutine function as `stage` of `endpoint`
+    """
+    def decorator(afn):
+        @functools.wraps(afn)
+        async def wrapper(*args, **kwargs):
+            with span(endpoint, stage):
+                return await afn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StageTimer:
+    """
+    times consecutive stages of a pipeline: `mark(stage)` records the time since the previous mark as `stage`
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        STAGE_SECONDS.labels(self.endpoint, stage).observe(now - self.last)
+        self.last = now
+
+    def total(self):
+        STAGE_SECONDS.labels(self.endpoint, 'total').observe(time.perf_counter() - self.start)
+
+
+def count_upstream(host: str, status):
+    UPSTREAM_REQUESTS.labels(host, str(status)).inc()
+
+
+def observe_upstream(host: str, status, seconds: float):
+    count_upstream(host, status)
+    UPSTREAM_SECONDS.labels(host).observe(seconds)
+
+
+@contextmanager
+def upstream_call(host: str):
+    """
+    time a call to `host`. its status is the one set in the yielded dict (e.g. the HTTP status of the response),
+    'ok' by default, or the HTTP status (or name) of the raised error
+    """
+    start = time.perf_counter()
+    call = {'status': 'ok'}
+    try:
+        yield call
+    except Exception as e:
+        call['status'] = getattr(e, 'status', None) or getattr(e, 'status_code', None) or type(e).__name__
+        raise
+    finally:
+        observe_upstream(host, call['status'], time.perf_counter() - start)
+
+
+def observe_documents(endpoint: str, source: str, count: int):
+    DOCUMENTS.labels(endpoint, source).observe(count)
+
+
+class CacheCollector:
+    """
+    exports the hit/miss counters of the caches (`stats()` of `cache_utils` caches) at scrape time
+    """
+
+    def __init__(self, caches: dict):
+        self.caches = caches
+
+    def collect(self):
+        family = CounterMetricFamily('cite4_cache_requests', "cache lookups by cache and result", labels=['cache', 'result'])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            family.add_metric([name, 'hit'], stats['hits'])
+            family.add_metric([name, 'stale_hit'], stats.get('stale_hits', 0))
+            family.add_metric([name, 'miss'], stats['misses'])
+        yield family
+
+
+def register_caches(caches: dict):
+    REGISTRY.register(CacheCollector(caches))
+
+
+def export_metrics():
+    """
+    (body, content type) of the Prometheus exposition of every metric
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,103 @@
+from collections import Counter
+import math
+import os
+import re
+import numpy as np
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from utils.db_utils import document_key, sync_documents
+
+# number of candidates kept by the lexical prefilter, i.e. embedded per request
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 200))
+# constant of reciprocal rank fusion
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in ENGLISH_STOP_WORDS]
+
+
+def document_text(document):
+    return f"{document.metadata.get('title') or ''}\n{document.page_content}"
+
+
+class BM25:
+    """
+    in-memory Okapi BM25 index over a list of texts, with postings per term so that
+    a query only touches the documents containing its terms
+    """
+
+    def __init__(self, texts, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        term_freqs = [Counter(tokenize(text)) for text in texts]
+        self.size = len(term_freqs)
+        self.lengths = np.array([sum(freqs.values()) for freqs in term_freqs], dtype=np.float32)
+        self.avg_length = max(float(self.lengths.mean()), 1.0) if self.size > 0 else 1.0
+        postings = {}
+        for idx, freqs in enumerate(term_freqs):
+            for term, freq in freqs.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(idx)
+                postings[term][1].append(freq)
+        self.postings = {term: (np.array(ids), np.array(freqs, dtype=np.float32))
+                         for term, (ids, freqs) in postings.items()}
+        self.idf = {term: math.log(1 + (self.size - len(ids) + 0.5) / (len(ids) + 0.5))
+                    for term, (ids, _) in self.postings.items()}
+
+    def scores(self, query: str):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, freqs = self.postings[term]
+            norm = freqs + self.k1 * (1 - self.b + self.b * self.lengths[ids] / self.avg_length)
+            scores[ids] += self.idf[term] * freqs * (self.k1 + 1) / norm
+        return scores
+
+
+def lexical_search(documents, query: str, k: int = 10):
+    """
+    rank `documents` with BM25 alone, without embedding anything
+    ## return
+    list of (document, BM25 score), best first
+    """
+    scores = BM25([document_text(document) for document in documents]).scores(query)
+    top = np.argsort(-scores, kind='stable')[:k]
+    return [(documents[idx], float(scores[idx])) for idx in top]
+
+
+def hybrid_search(db, documents, query: str, k: int = 10, candidates: int = HYBRID_CANDIDATES, rrf_k: int = RRF_K):
+    """
+    hybrid ranking: BM25 over titles/abstracts keeps the best `candidates` documents,
+    only those are embedded into `db`, and the lexical and vector rankings are merged with reciprocal rank fusion.
+    documents without any query term only get the vector part of the fused score.
+    ## args
+    - db: empty index (e.g. `InMemoryIndex`) the candidates are embedded into
+    - documents: candidate pool
+    - query: query
+    - k: number of results
+    ## return
+    list of (document, fused score), best first: unlike the distances of the vector indexes, higher is better
+    """
+    unique = {}
+    for document in documents:
+        unique.setdefault(document_key(document), document)
+    documents = list(unique.values())
+    if len(documents) == 0:
+        return []
+    scores = BM25([document_text(document) for document in documents]).scores(query)
+    top = np.argsort(-scores, kind='stable')[:candidates]
+    survivors = [documents[idx] for idx in top]
+    lexical_rank = {document_key(documents[idx]): rank for rank, idx in enumerate(top) if scores[idx] > 0}
+    sync_documents(db=db, documents=survivors)
+    fused = []
+    for rank, (document, _) in enumerate(db.similarity_search_with_score(query, k=len(survivors))):
+        score = 1.0 / (rrf_k + rank + 1)
+        key = document_key(document)
+        if key in lexical_rank:
+            score += 1.0 / (rrf_k + lexical_rank[key] + 1)
+        fused.append((document, score))
+    fused.sort(key=lambda item: -item[1])
+    return fused[:k]
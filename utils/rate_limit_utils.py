@@ -0,0 +1,219 @@
+import asyncio
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+import httpx
+import requests
+from utils.http_utils import get_async_client, get_session
+from utils.metrics_utils import upstream_call
+
+# (requests per second, burst) of each upstream host.
+# override with e.g. RATE_LIMIT_API_SEMANTICSCHOLAR_ORG="1,1"
+DEFAULT_RATES = {
+    'api.semanticscholar.org': (1.0, 1),
+    'model-apis.semanticscholar.org': (1.0, 1),
+    'export.arxiv.org': (1 / 3, 1),
+    'api.zotero.org': (0.5, 1),
+    'duckduckgo.com': (1.0, 1),
+    'api.openai.com': (20.0, 8),
+}
+RETRY_STATUS = (429, 503)
+MAX_RETRIES = 4
+# errors raised before any response (timeouts, refused or dropped connections), retried like `RETRY_STATUS`
+TRANSPORT_ERRORS = (requests.Timeout, requests.ConnectionError)
+ATRANSPORT_ERRORS = (httpx.TransportError,)
+# status of the response standing in for a request whose retries all failed with a transport error
+TRANSPORT_ERROR_STATUS = 504
+
+
+class RateLimiter:
+    """
+    process-wide token bucket for one upstream: on average `rate` calls start per second,
+    with up to `burst` calls allowed back to back.
+    usable from both threads (`acquire`) and coroutines (`aacquire`).
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self._next = 0.0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next - (self.burst - 1) * self.interval, self._blocked_until)
+            self._next = max(self._next, start) + self.interval
+            return start - now
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """
+        block every caller for `seconds`, e.g. after a 429 with `Retry-After`
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host: str):
+    """
+    return the shared `RateLimiter` of `host`
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            rate, burst = DEFAULT_RATES.get(host, (1.0, 1))
+            setting = os.getenv("RATE_LIMIT_" + re.sub(r'[^A-Z0-9]', '_', host.upper()))
+            if setting:
+                rate, _, burst = setting.partition(',')
+                rate, burst = float(rate), int(burst or 1)
+            _limiters[host] = RateLimiter(rate=rate, burst=burst)
+        return _limiters[host]
+
+
+def backoff_seconds(attempt: int, base: float = 1.0, cap: float = 60.0):
+    """
+    exponential backoff with full jitter
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(headers):
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_status(error: Exception):
+    """
+    HTTP status carried by an error of a client library, or `None`
+    """
+    for value in (getattr(error, 'status', None), getattr(error, 'status_code', None),
+                  getattr(getattr(error, 'response', None), 'status_code', None)):
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def error_retry_after(error: Exception):
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    return retry_after_seconds(headers) if headers is not None else None
+
+
+def call_with_retries(host: str, fn, *args, retry_on: tuple = (), retry_after=error_retry_after,
+                      max_retries: int = MAX_RETRIES, record_upstream=True, **kwargs):
+    """
+    `fn(*args, **kwargs)` of a client library calling `host`, paced and retried like `request`:
+    errors of the library's rate-limit types `retry_on`, or carrying a 429/503 status, are retried
+    after `retry_after(error)` seconds (e.g. from `Retry-After`) or a jittered backoff.
+    each attempt is recorded in the upstream metrics unless `record_upstream` is false
+    (libraries using the shared sessions of `http_utils` are already recorded there).
+    """
+    limiter = get_limiter(host)
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            with upstream_call(host) if record_upstream else nullcontext():
+                return fn(*args, **kwargs)
+        except Exception as e:
+            if not (isinstance(e, retry_on) or error_status(e) in RETRY_STATUS) or attempt == max_retries:
+                raise
+            wait = retry_after(e)
+            limiter.penalize(wait if wait is not None else backoff_seconds(attempt))
+
+
+def request(method: str, url: str, max_retries: int = MAX_RETRIES, **kwargs):
+    """
+    request on the shared session of the url's host (`http_utils`), paced by the host's limiter,
+    retrying 429/503 responses after `Retry-After` (or a jittered backoff) and transport errors after a backoff.
+    a request that keeps failing with transport errors returns a `TRANSPORT_ERROR_STATUS` response,
+    so that callers handle it like any failed status
+    """
+    host = urlparse(url).hostname
+    limiter = get_limiter(host)
+    session = get_session(host)
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except TRANSPORT_ERRORS as e:
+            if attempt == max_retries:
+                return failed_response(url, e)
+            limiter.penalize(backoff_seconds(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == max_retries:
+            return response
+        wait = retry_after_seconds(response.headers)
+        limiter.penalize(wait if wait is not None else backoff_seconds(attempt))
+    return response
+
+
+async def arequest(client, method: str, url: str, max_retries: int = MAX_RETRIES, **kwargs):
+    """
+    async version of `request` for an `httpx.AsyncClient` (the shared client of `http_utils` when `client` is `None`)
+    """
+    if client is None:
+        client = get_async_client()
+    host = urlparse(url).hostname
+    limiter = get_limiter(host)
+    for attempt in range(max_retries + 1):
+        await limiter.aacquire()
+        try:
+            with upstream_call(host) as call:
+                response = await client.request(method, url, **kwargs)
+                call['status'] = response.status_code
+        except ATRANSPORT_ERRORS as e:
+            if attempt == max_retries:
+                return afailed_response(method, url, e)
+            limiter.penalize(backoff_seconds(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == max_retries:
+            return response
+        wait = retry_after_seconds(response.headers)
+        limiter.penalize(wait if wait is not None else backoff_seconds(attempt))
+    return response
+
+
+def failed_response(url: str, error: Exception):
+    """
+    `requests.Response` standing in for a request that got no response
+    """
+    response = requests.Response()
+    response.status_code = TRANSPORT_ERROR_STATUS
+    response.reason = type(error).__name__
+    response.url = url
+    response._content = str(error).encode()
+    return response
+
+
+def afailed_response(method: str, url: str, error: Exception):
+    """
+    `httpx.Response` standing in for a request that got no response
+    """
+    return httpx.Response(TRANSPORT_ERROR_STATUS, text=str(error), request=httpx.Request(method, url))
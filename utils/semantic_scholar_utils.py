@@ -1,21 +1,63 @@
-import requests
+import asyncio
+from functools import partial
 import os
-from dotenv import find_dotenv, load_dotenv
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from utils.cache_utils import EmbeddingCache, ResponseCache
+from utils.concurrency_utils import KeyedLocks, SingleFlight
+from utils.graph_utils import GraphStore, NEIGHBOR_KEY, PAPER_FIELDS
+from utils.rate_limit_utils import request, arequest
+from utils.settings_utils import SEMANTIC_SCHOLAR_API_KEY
 BASE_URL = "https://api.semanticscholar.org"
 academic_graph_url = BASE_URL+"/graph/v1"
 recommendation_url = BASE_URL + "/recommendations/v1"
+GRAPH_FIELDS = 'paperId,title,abstract,year,isInfluential,url,citationCount'
+# SPECTER (v1) vector of each paper, returned inline with the other fields
+EMBEDDING_FIELDS = GRAPH_FIELDS + ',embedding'
+SEED_FIELDS = 'paperId,citationCount,referenceCount'
+# count of the seed paper that tells whether its stored neighbourhood is still complete
+COUNT_FIELD = {'references': 'referenceCount', 'citations': 'citationCount'}
+GRAPH_PAGE_SIZE = 1000
+
+graph_cache = ResponseCache(
+    name='semantic_scholar',
+    ttl=float(os.getenv('SEMANTIC_SCHOLAR_CACHE_TTL', 60 * 60 * 24)),
+    stale_ttl=float(os.getenv('SEMANTIC_SCHOLAR_CACHE_STALE_TTL', 60 * 60 * 24 * 7)),
+    max_entries=int(os.getenv('SEMANTIC_SCHOLAR_CACHE_MAX_ENTRIES', 20000))
+)
+# SPECTER vectors of the `EMBEDDING_FIELDS` fetches, by paper id: `graph_cache` only keeps their text fields
+specter_cache = EmbeddingCache(
+    name='specter',
+    max_entries=int(os.getenv('SPECTER_CACHE_MAX_ENTRIES', 200000))
+)
+# the seed (paper id and counts) is shared by the references and citations of a paper, so it is fetched once;
+# it decides whether a stored neighbourhood is still complete, hence the short ttl
+seed_cache = ResponseCache(
+    name='semantic_scholar_seeds',
+    ttl=float(os.getenv('SEMANTIC_SCHOLAR_SEED_TTL', 60 * 10)),
+    stale_ttl=0
+)
+seed_locks = KeyedLocks()
+seed_flight = SingleFlight()
+# concurrent fetches of the same neighbourhood (streaming or not) share one walk of its pages
+graph_flight = SingleFlight()
+graph_store = GraphStore(path=os.getenv('GRAPH_DB_PATH', './graph.sqlite3'))
+# maximum number of references/citations fetched per paper (pages of `GRAPH_PAGE_SIZE`)
+GRAPH_MAX_ITEMS = int(os.getenv('SEMANTIC_SCHOLAR_MAX_ITEMS', 5000))
+
+
+def api_headers():
+    # without a key the API is used anonymously (httpx rejects a `None` header value)
+    return {'x-api-key': SEMANTIC_SCHOLAR_API_KEY} if SEMANTIC_SCHOLAR_API_KEY else {}
 
 
 def search_query(query: str):
-    load_dotenv(find_dotenv())
-    api_key = os.getenv('SEMANTIC_SCHOLAR_API_KEY')
     query_search = academic_graph_url + "/paper/search"
     query_params = {
         'query': query, 'fields': 'title,abstract,authors,year,url,citationStyles', 'fieldsOfStudy': "Computer Science,Engineering" ,'limit': 100}
-    headers = {'x-api-key': api_key}
+    headers = api_headers()
 
-    response = requests.get(query_search, params=query_params, headers=headers)
+    response = request('GET', query_search, params=query_params, headers=headers)
     if response.status_code == 200:
         response_data = response.json()
     else:
@@ -44,17 +86,314 @@ def search_query(query: str):
 
     # TODO search paper
 
-def get_citations(arxiv_id: str):
-    load_dotenv(find_dotenv())
-    references = academic_graph_url + f"/paper/ARXIV:{arxiv_id}/references"
-    params = {'limit': 1000, 'fields': 'title,abstract,year,isInfluential,url'}
-    api_key = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
-    headers = {'x-api-key': api_key}
-    response = requests.get(references, params=params, headers=headers)
+def load_stored_graph(seed: dict, endpoint: str, fields: str):
+    """
+    return the neighbourhood of `seed` from `graph_store` if it was stored at the seed's current count
+    """
+    if not set(fields.split(',')) <= set(PAPER_FIELDS) | {'isInfluential'}:
+        return None
+    count = seed.get(COUNT_FIELD[endpoint])
+    if count is None or graph_store.get_neighborhood_count(seed['paperId'], endpoint) != count:
+        return None
+    return graph_store.load_neighborhood(seed['paperId'], endpoint)
+
+
+def store_graph(seed: dict, endpoint: str, response_data: dict, complete=True):
+    count = seed.get(COUNT_FIELD[endpoint])
+    if complete:
+        graph_store.store_neighborhood(seed['paperId'], endpoint, response_data['data'], count=count)
+    elif graph_store.get_neighborhood_count(seed['paperId'], endpoint) != count:
+        # a capped neighbourhood is only added, so that it is never served as complete
+        # and never deletes edges of the complete neighbourhoods of other papers
+        graph_store.store_neighborhood(seed['paperId'], endpoint, response_data['data'], replace=False)
 
+
+def detach_vectors(response_data: dict, endpoint: str):
+    """
+    move the SPECTER vectors of the items to `specter_cache` and return the items without them
+    """
+    if response_data is None:
+        return None
+    side = NEIGHBOR_KEY[endpoint]
+    vectors = {}
+    items = []
+    for item in response_data['data']:
+        paper = item[side]
+        if paper.get('paperId') is not None and specter_vector(paper) is not None:
+            vectors[paper['paperId']] = specter_vector(paper)
+        items.append({**item, side: {key: value for key, value in paper.items() if key != 'embedding'}})
+    if len(vectors) > 0:
+        specter_cache.set_many(vectors)
+    return {**response_data, 'data': items}
+
+
+def attach_vectors(response_data: dict, endpoint: str):
+    """
+    inverse of `detach_vectors`; items whose vector was evicted are left without one (and embedded by the index)
+    """
+    if response_data is None:
+        return None
+    side = NEIGHBOR_KEY[endpoint]
+    vectors = specter_cache.get_many([item[side]['paperId'] for item in response_data['data']
+                                      if item[side].get('paperId') is not None])
+    items = [{**item, side: {**item[side], 'embedding': {'vector': vectors[item[side]['paperId']]}}}
+             if item[side].get('paperId') in vectors else item
+             for item in response_data['data']]
+    return {**response_data, 'data': items}
+
+
+def filter_years(items: list, endpoint: str, min_year: int = None, max_year: int = None):
+    if min_year is None and max_year is None:
+        return items
+    side = NEIGHBOR_KEY[endpoint]
+    return [item for item in items
+            if item[side].get('year') is not None
+            and (min_year is None or item[side]['year'] >= min_year)
+            and (max_year is None or item[side]['year'] <= max_year)]
+
+
+def fetch_graph_page(arxiv_id: str, endpoint: str, fields: str = GRAPH_FIELDS, offset: int = 0, limit: int = GRAPH_PAGE_SIZE):
+    """
+    fetch one page of `references` or `citations` of the paper
+    ## return
+    the response data (with `next` when there are more pages), or `None` if the request failed
+    """
+    url = academic_graph_url + f"/paper/ARXIV:{arxiv_id}/{endpoint}"
+    params = {'offset': offset, 'limit': limit, 'fields': fields}
+    headers = api_headers()
+    response = request('GET', url, params=params, headers=headers)
     if response.status_code == 200:
-        response_data = response.json()
-    else:
+        return response.json()
+    return None
+
+
+async def afetch_graph_page(arxiv_id: str, endpoint: str, fields: str = GRAPH_FIELDS, offset: int = 0,
+                            limit: int = GRAPH_PAGE_SIZE, client=None):
+    """
+    async version of `fetch_graph_page`
+    """
+    url = academic_graph_url + f"/paper/ARXIV:{arxiv_id}/{endpoint}"
+    params = {'offset': offset, 'limit': limit, 'fields': fields}
+    headers = api_headers()
+    response = await arequest(client, 'GET', url, params=params, headers=headers)
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+def fetch_seed(arxiv_id: str):
+    """
+    fetch the id and citation/reference counts of the paper and record it in `graph_store`
+    """
+    url = academic_graph_url + f"/paper/ARXIV:{arxiv_id}"
+    headers = api_headers()
+    response = request('GET', url, params={'fields': SEED_FIELDS}, headers=headers)
+    if response.status_code != 200:
+        return None
+    seed = response.json()
+    graph_store.upsert_papers([seed], arxiv_id=arxiv_id)
+    return seed
+
+
+async def afetch_seed(arxiv_id: str, client=None):
+    """
+    async version of `fetch_seed`
+    """
+    url = academic_graph_url + f"/paper/ARXIV:{arxiv_id}"
+    headers = api_headers()
+    response = await arequest(client, 'GET', url, params={'fields': SEED_FIELDS}, headers=headers)
+    if response.status_code != 200:
+        return None
+    seed = response.json()
+    graph_store.upsert_papers([seed], arxiv_id=arxiv_id)
+    return seed
+
+
+def get_seed(arxiv_id: str):
+    """
+    `fetch_seed` served from `seed_cache`; concurrent callers of the same paper share one request
+    """
+    with seed_locks.lock(arxiv_id):
+        return seed_cache.get_or_fetch(arxiv_id, partial(fetch_seed, arxiv_id))
+
+
+async def aget_seed(arxiv_id: str):
+    """
+    async version of `get_seed`
+    """
+    return await seed_flight.do(arxiv_id, seed_cache.aget_or_fetch, arxiv_id, partial(afetch_seed, arxiv_id))
+
+
+class GraphWalk:
+    """
+    walk of the pages of `references` or `citations` of a paper, following the `next` offset up to `max_items` items.
+    shared by `fetch_paper_graph` and `afetch_paper_graph`, which only differ in how a page is requested:
+        walk = GraphWalk(max_items)
+        while not walk.done:
+            walk.add(fetch_graph_page(arxiv_id, endpoint, fields, walk.offset, walk.limit))
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.items = []
+        self.offset = 0
+        self.complete = False
+        self.failed = False
+        self.done = max_items <= 0
+
+    @property
+    def limit(self):
+        return min(GRAPH_PAGE_SIZE, self.max_items - len(self.items))
+
+    def add(self, page):
+        """
+        record a page (`None` if its request failed) and return its items
+        """
+        if page is None:
+            # a truncated walk must not be cached or stored as the whole neighbourhood
+            self.failed = True
+            self.done = True
+            return []
+        self.items += page['data']
+        if 'next' not in page:
+            self.complete = True
+        else:
+            self.offset = page['next']
+        self.done = self.complete or len(self.items) >= self.max_items
+        return page['data']
+
+    def result(self, seed: dict, endpoint: str):
+        """
+        the response data of the walk (`None` if any page failed), stored in `graph_store`
+        """
+        if self.failed:
+            return None
+        response_data = {'data': self.items}
+        if seed is not None:
+            store_graph(seed, endpoint, response_data, complete=self.complete)
+        return response_data
+
+
+def graph_key(arxiv_id: str, endpoint: str, fields: str, max_items: int):
+    return f"{endpoint}:{arxiv_id}:{fields}:{max_items}"
+
+
+def cached_graph(response_data: dict, endpoint: str, fields: str):
+    """
+    the part of a walk kept in `graph_cache`: SPECTER vectors go to `specter_cache` as binary instead of JSON
+    """
+    if 'embedding' not in fields.split(','):
+        return response_data
+    return detach_vectors(response_data, endpoint)
+
+
+def served_graph(response_data: dict, endpoint: str, fields: str):
+    """
+    inverse of `cached_graph`
+    """
+    if 'embedding' not in fields.split(','):
+        return response_data
+    return attach_vectors(response_data, endpoint)
+
+
+def load_seed_graph(seed: dict, endpoint: str, fields: str, max_items: int):
+    if seed is None:
+        return None
+    stored = load_stored_graph(seed, endpoint, fields)
+    if stored is None:
+        return None
+    return {'data': stored['data'][:max_items]}
+
+
+def fetch_paper_graph(arxiv_id: str, endpoint: str, fields: str = GRAPH_FIELDS, max_items: int = GRAPH_MAX_ITEMS):
+    """
+    fetch `references` or `citations` of the paper, following pages up to `max_items` items.
+    served from `graph_cache` when possible, then from `graph_store` when the paper's count did not change
+    ## args
+    - arxiv_id: arxiv number of the paper
+    - endpoint: 'references' or 'citations'
+    - fields: fields requested for each paper
+    - max_items: maximum number of items
+    ## return
+    the response data, or `None` if the request failed
+    """
+    def fetch():
+        seed = get_seed(arxiv_id)
+        stored = load_seed_graph(seed, endpoint, fields, max_items)
+        if stored is not None:
+            return stored
+        walk = GraphWalk(max_items)
+        while not walk.done:
+            walk.add(fetch_graph_page(arxiv_id, endpoint, fields, walk.offset, walk.limit))
+        return cached_graph(walk.result(seed, endpoint), endpoint, fields)
+
+    response_data = graph_cache.get_or_fetch(graph_key(arxiv_id, endpoint, fields, max_items), fetch)
+    return served_graph(response_data, endpoint, fields)
+
+
+async def afetch_paper_graph(arxiv_id: str, endpoint: str, fields: str = GRAPH_FIELDS, max_items: int = GRAPH_MAX_ITEMS,
+                             min_year: int = None, max_year: int = None, on_page=None):
+    """
+    async version of `fetch_paper_graph`. concurrent calls for the same paper share one fetch (`graph_flight`),
+    which stops once every caller has been cancelled.
+    `on_page(items)` (a coroutine function) receives the items as they arrive: page by page when this call
+    walks the pages itself, otherwise all at once.
+    the endpoints have no year filter, so `min_year`/`max_year` are applied to the delivered items,
+    while the cache and `graph_store` keep every item.
+    """
+    delivered = False
+    finished = False
+
+    async def fetch():
+        nonlocal delivered
+        seed = await aget_seed(arxiv_id)
+        stored = load_seed_graph(seed, endpoint, fields, max_items)
+        if stored is not None:
+            return stored
+        walk = GraphWalk(max_items)
+        while not walk.done:
+            items = walk.add(await afetch_graph_page(arxiv_id, endpoint, fields, walk.offset, walk.limit))
+            # a background refresh of a stale entry, or another caller's walk, may run after this call returned
+            if on_page is not None and not finished:
+                delivered = True
+                items = filter_years(items, endpoint, min_year, max_year)
+                if len(items) > 0:
+                    await on_page(items)
+        return cached_graph(walk.result(seed, endpoint), endpoint, fields)
+
+    key = graph_key(arxiv_id, endpoint, fields, max_items)
+    try:
+        response_data = await graph_flight.do(key, graph_cache.aget_or_fetch, key, fetch)
+    finally:
+        finished = True
+    response_data = served_graph(response_data, endpoint, fields)
+    if response_data is None:
+        return None
+    response_data = {'data': filter_years(response_data['data'], endpoint, min_year, max_year)}
+    if on_page is not None and not delivered:
+        await on_page(response_data['data'])
+    return response_data
+
+
+def get_citations(arxiv_id: str, with_embedding=False):
+    fields = EMBEDDING_FIELDS if with_embedding else GRAPH_FIELDS
+    return references_to_documents(fetch_paper_graph(arxiv_id, 'references', fields=fields), with_embedding)
+
+
+async def aget_citations(arxiv_id: str, with_embedding=False):
+    fields = EMBEDDING_FIELDS if with_embedding else GRAPH_FIELDS
+    return references_to_documents(await afetch_paper_graph(arxiv_id, 'references', fields=fields), with_embedding)
+
+
+def specter_vector(paper: dict):
+    """
+    the inline SPECTER vector of a Graph API paper, or `None` if it has none
+    """
+    return (paper.get('embedding') or {}).get('vector')
+
+
+def references_to_documents(response_data, with_embedding=False):
+    if response_data is None:
         # request failed
         return [], 0
     influential_papers = []
@@ -62,32 +401,63 @@ def get_citations(arxiv_id: str):
     cnt = 0
     for inst in response_data['data']:
         # if inst['isInfluential'] and inst['citingPaper']['abstract'] is not None and inst['citingPaper']['paperId'] not in paperId:
-        if inst['citedPaper']['abstract'] is not None and inst['citedPaper']['title'] not in paperId and inst['citedPaper']['url'] is not None and inst['citedPaper']['year'] is not None:
+        if inst['citedPaper']['abstract'] is not None and inst['citedPaper']['paperId'] not in paperId and inst['citedPaper']['url'] is not None and inst['citedPaper']['year'] is not None:
             cnt += 1
             paperId.add(inst['citedPaper']['paperId'])
+            metadata = {'title': inst['citedPaper']['title'],
+                        'year': inst['citedPaper']['year'],
+                        'url': inst['citedPaper']['url'],
+                        'paperId': inst['citedPaper']['paperId'],
+                        'type': 'citation'}
+            if with_embedding:
+                metadata['embedding'] = specter_vector(inst['citedPaper'])
             influential_papers.append(Document(
                 page_content=inst['citedPaper']['abstract'],
-                metadata={'title': inst['citedPaper']['title'],
-                          'year': inst['citedPaper']['year'],
-                          'url': inst['citedPaper']['url'],
-                          'type': 'citation'},
-                          
+                metadata=metadata,
                 id=cnt
             ))
             # TODO should Document id be unique?
     return influential_papers, cnt
 
-def get_cited_papers(arxiv_id: str):
-    load_dotenv(find_dotenv())
-    citations = academic_graph_url + f"/paper/ARXIV:{arxiv_id}/citations"
-    params = {'limit': 1000, 'fields': 'title,abstract,year,isInfluential,url'}
-    api_key = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
-    headers = {'x-api-key': api_key}
-    response = requests.get(citations, params=params, headers=headers)
+async def aiter_graph_documents(arxiv_id: str, endpoint: str, with_embedding=False, max_items: int = GRAPH_MAX_ITEMS,
+                                min_year: int = None, max_year: int = None):
+    """
+    yield the documents of `references` or `citations` page by page as they arrive,
+    so that they can be embedded while the next pages are fetched.
+    the pages come from `afetch_paper_graph`, which caches, stores and coalesces them like the non-streaming fetches;
+    closing the generator early also stops the walk unless another caller is still waiting on it.
+    """
+    to_documents = references_to_documents if endpoint == 'references' else citations_to_documents
+    fields = EMBEDDING_FIELDS if with_embedding else GRAPH_FIELDS
+    pages = asyncio.Queue()
+    fetch = asyncio.ensure_future(afetch_paper_graph(arxiv_id, endpoint, fields=fields, max_items=max_items,
+                                                     min_year=min_year, max_year=max_year, on_page=pages.put))
+    # every page is queued before the fetch completes, so `None` marks the end
+    fetch.add_done_callback(lambda _: pages.put_nowait(None))
+    try:
+        while True:
+            items = await pages.get()
+            if items is None:
+                break
+            documents, cnt = to_documents({'data': items}, with_embedding)
+            yield documents
+        fetch.result()
+    finally:
+        fetch.cancel()
 
-    if response.status_code == 200:
-        response_data = response.json()
-    else:
+
+def get_cited_papers(arxiv_id: str, with_embedding=False):
+    fields = EMBEDDING_FIELDS if with_embedding else GRAPH_FIELDS
+    return citations_to_documents(fetch_paper_graph(arxiv_id, 'citations', fields=fields), with_embedding)
+
+
+async def aget_cited_papers(arxiv_id: str, with_embedding=False):
+    fields = EMBEDDING_FIELDS if with_embedding else GRAPH_FIELDS
+    return citations_to_documents(await afetch_paper_graph(arxiv_id, 'citations', fields=fields), with_embedding)
+
+
+def citations_to_documents(response_data, with_embedding=False):
+    if response_data is None:
         # raise Exception(
         #     f"Request failed with status code {response.status_code}: {response.text}")
         return [], 0
@@ -98,28 +468,53 @@ def get_cited_papers(arxiv_id: str):
     cnt = 0
     for inst in response_data['data']:
         # if inst['isInfluential'] and inst['citingPaper']['abstract'] is not None and inst['citingPaper']['paperId'] not in paperId:
-        if inst['citingPaper']['abstract'] is not None and inst['citingPaper']['title'] not in paperId and inst['citingPaper']['url'] is not None and inst['citingPaper']['year'] is not None:
+        if inst['citingPaper']['abstract'] is not None and inst['citingPaper']['paperId'] not in paperId and inst['citingPaper']['url'] is not None and inst['citingPaper']['year'] is not None:
             cnt += 1
             paperId.add(inst['citingPaper']['paperId'])
+            metadata = {'title': inst['citingPaper']['title'],
+                        'year': inst['citingPaper']['year'],
+                        'url': inst['citingPaper']['url'],
+                        'paperId': inst['citingPaper']['paperId'],
+                        'type': 'cited paper'}
+            if with_embedding:
+                metadata['embedding'] = specter_vector(inst['citingPaper'])
             influential_papers.append(Document(
                 page_content=inst['citingPaper']['abstract'],
-                metadata={'title': inst['citingPaper']['title'],
-                          'year': inst['citingPaper']['year'],
-                          'url': inst['citingPaper']['url'],
-                          'type': 'cited paper'},
+                metadata=metadata,
                 id=cnt
             ))
             # TODO should Document id be unique?
     return influential_papers, cnt
 
 
+def get_papers_batch(paper_ids: list, fields: str = 'title,externalIds', batch_size: int = 500):
+    """
+    fetch many papers in one round-trip with the `/paper/batch` endpoint
+    ## args
+    - paper_ids: ids understood by Semantic Scholar (e.g. paperId, 'DOI:...', 'ARXIV:...')
+    - fields: fields requested for each paper
+    ## return
+    list aligned with `paper_ids`, with `None` for papers that were not found
+    """
+    batch_url = academic_graph_url + '/paper/batch'
+    headers = api_headers()
+    papers = []
+    for start in range(0, len(paper_ids), batch_size):
+        chunk = paper_ids[start:start + batch_size]
+        response = request('POST', batch_url, params={'fields': fields}, json={'ids': chunk}, headers=headers)
+        if response.status_code == 200:
+            papers.extend(response.json())
+        else:
+            print(f"Request failed with status code {response.status_code}: {response.text}")
+            papers.extend([None] * len(chunk))
+    return papers
+
+
 def convert_to_paper_id(paper_title: str):
-    load_dotenv(find_dotenv())
     title_search = academic_graph_url + '/paper/search/match'
     params = {'query': paper_title, 'fields': 'title,paperId'}
-    api_key = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
-    headers = {'x-api-key': api_key}
-    response = requests.get(title_search, params=params, headers=headers)
+    headers = api_headers()
+    response = request('GET', title_search, params=params, headers=headers)
     if response.status_code == 200:
         data = response.json()
         print(data)
@@ -144,7 +539,7 @@ def get_embeddings(papers: list, batch_size=16):
     while cnt < len(papers):
         upper_bound = min(cnt + MAX_BATCH_SIZE, len(papers))
         chunk = papers[cnt:upper_bound]
-        response = requests.post(URL, json=chunk)
+        response = request('POST', URL, json=chunk)
         if response.status_code != 200:
             raise RuntimeError("Sorry, something went wrong, please try later!")
 
@@ -155,15 +550,35 @@ def get_embeddings(papers: list, batch_size=16):
     return embeddings_by_paper_id
 
 
+class SpecterEmbeddings(Embeddings):
+    """
+    SPECTER embeddings from the Semantic Scholar model API, the model behind the Graph API `embedding` field.
+    a text is split into title and abstract at its first blank line, as in `specter_text`.
+    """
+
+    def embed_documents(self, texts):
+        papers = []
+        for idx, text in enumerate(texts):
+            title, _, abstract = text.partition('\n\n')
+            papers.append({'paper_id': str(idx), 'title': title, 'abstract': abstract})
+        embeddings_by_paper_id = get_embeddings(papers)
+        return [embeddings_by_paper_id[str(idx)] for idx in range(len(texts))]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def specter_text(document: Document):
+    return f"{document.metadata.get('title') or ''}\n\n{document.page_content}"
+
+
 def recommend_paper(paper_title: str):
-    load_dotenv(find_dotenv())
     paper_id = convert_to_paper_id(paper_title)
     print(paper_id)
     recommend = recommendation_url + f"/papers/forpaper/{paper_id}"
     params = {'fields': "title,url,year,abstract"}
-    api_key = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
-    headers = {'x-api-key': api_key}
-    response = requests.get(recommend, params=params, headers=headers)
+    headers = api_headers()
+    response = request('GET', recommend, params=params, headers=headers)
     if response.status_code == 200:
         # Parse the JSON response
         data = response.json()
@@ -0,0 +1,16 @@
+"""
+process-wide settings. the `.env` file is located and loaded once, when this module is first imported,
+so modules import their settings from here (or import it before reading `os.environ`)
+instead of calling `load_dotenv(find_dotenv())` on every request.
+"""
+import os
+from dotenv import find_dotenv, load_dotenv
+
+load_dotenv(find_dotenv())
+
+# seconds to wait for a connection and for each read of an upstream response
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+# keep-alive connections kept per upstream host
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))
+SEMANTIC_SCHOLAR_API_KEY = os.getenv('SEMANTIC_SCHOLAR_API_KEY')
@@ -1,11 +1,12 @@
 from langchain_community.document_loaders import ArxivLoader
 from bs4 import BeautifulSoup
-import requests
 from typing import List
 from uuid import uuid4
 from langchain_core.documents import Document
 from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
-from utils.arxiv_utils import load_paper_arxiv_api
+from duckduckgo_search.exceptions import RatelimitException
+from utils.arxiv_utils import link_to_arxiv_id, load_papers_arxiv_api
+from utils.rate_limit_utils import call_with_retries, get_limiter, request
 
 
 def duckduckgoSearch(query: str, max_results=100):
@@ -16,29 +17,33 @@ def duckduckgoSearch(query: str, max_results=100):
     - max_results: number of result
     """
     wrapper = DuckDuckGoSearchAPIWrapper()
-    output = wrapper.results(query=query, max_results=max_results)
+    output = call_with_retries('duckduckgo.com', wrapper.results, query=query, max_results=max_results,
+                               retry_on=(RatelimitException,))
     print(len(output))
-    arxivSet = set()
+    arxivIds = []
+    for inst in output:
+        arxivId = link_to_arxiv_id(inst['link'])
+        if arxivId is not None and arxivId not in arxivIds:
+            arxivIds.append(arxivId)
+    # metadata of every arxiv link is resolved with batched `id_list` queries
+    papers = load_papers_arxiv_api(arxivIds)
     result = []
     idx = 0
-    for inst in output:
-        if 'arxiv.org' in inst['link'] and 'ar5iv' not in inst['link']:
-            arxivId = inst['link'].split('/')[-1]
-            if 'v' in arxivId:
-                arxivId = arxivId.split('v')[0]
-            if arxivId not in arxivSet:
-                arxivSet.add(arxivId)
-                paper_info = load_paper_arxiv_api(arxiv_id=arxivId)
-                document = Document(
-                    page_content=paper_info.summary,
-                    metadata={'title': paper_info.title,
-                              'year': paper_info.published.strftime("%Y"),
-                              'url': paper_info.entry_id,
-                              'type': "internet"},
-                    id=idx
-                )
-                result.append(document)
-                idx += 1
+    for arxivId in arxivIds:
+        if arxivId not in papers:
+            continue
+        paper_info = papers[arxivId]
+        document = Document(
+            page_content=paper_info.summary,
+            metadata={'title': paper_info.title,
+                      'year': paper_info.published.strftime("%Y"),
+                      'url': paper_info.entry_id,
+                      'arxivId': arxivId,
+                      'type': "internet"},
+            id=idx
+        )
+        result.append(document)
+        idx += 1
     return result
 
 
@@ -53,7 +58,7 @@ def fetch_paper_list(event: str, year: str, paper_type: str) -> List:
     List of the title of the paper
     """
     url = f"https://aclanthology.org/events/{event}-{year}/"
-    response = requests.get(url)
+    response = request('GET', url)
     if response.status_code == 200:
         html = response.text
         soup = BeautifulSoup(html, 'html.parser')
@@ -79,7 +84,7 @@ def fetch_title_and_abstract(event: str, year: str, paper_type: str) -> List:
 def ml_fetcher(event: str, year: str, paper_type: str) -> List:
     event = event.capitalize()
     url = f"https://openreview.net/group?id={event}.cc/2024/Conference#tab-accept-oral"
-    response = requests.get(url)
+    response = request('GET', url)
     if response.status_code == 200:
         html = response.text
         soup = BeautifulSoup(html, 'html.parser')
@@ -94,7 +99,7 @@ def ml_fetcher(event: str, year: str, paper_type: str) -> List:
 
 def nlp_fetcher(event: str, year: str, paper_type: str) -> List:
     url = f"https://aclanthology.org/events/{event}-{year}/"
-    response = requests.get(url)
+    response = request('GET', url)
     if response.status_code == 200:
         html = response.text
         soup = BeautifulSoup(html, 'html.parser')
@@ -131,6 +136,7 @@ def nlp_fetcher(event: str, year: str, paper_type: str) -> List:
 
 def load_paper(arxiv_id: str):
     try:
+        get_limiter('export.arxiv.org').acquire()
         paper_load = ArxivLoader(
             query=arxiv_id,
             load_max_docs=1
@@ -143,6 +149,7 @@ def load_paper(arxiv_id: str):
 
 def title_to_abstract(title: str) -> str:
     try:
+        get_limiter('export.arxiv.org').acquire()
         paper_load = ArxivLoader(
             query=title,
             load_max_docs=1
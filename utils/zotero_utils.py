@@ -1,14 +1,29 @@
-from pyzotero import zotero
 import time
+from pyzotero import zotero, zotero_errors
+from utils.rate_limit_utils import call_with_retries
+
+# rate-limit errors of pyzotero (`TooManyRetriesError` only exists in the versions that retry on their own)
+RATE_LIMIT_ERRORS = tuple(getattr(zotero_errors, name) for name in ('TooManyRequestsError', 'TooManyRetriesError')
+                          if hasattr(zotero_errors, name))
+
+
 class Zotero:
     def __init__(self, library_id, library_type, api_key):
         self.zot = zotero.Zotero(library_id=library_id,
                                  library_type=library_type,
                                  api_key=api_key)
+
+    def server_backoff(self, error=None):
+        # pyzotero records the `Backoff`/`Retry-After` of the server on the client instead of the error
+        return max(0.0, getattr(self.zot, 'backoff_until', 0.0) - time.time()) or None
+
+    def call(self, fn, *args):
+        return call_with_retries('api.zotero.org', fn, *args, retry_on=RATE_LIMIT_ERRORS,
+                                 retry_after=self.server_backoff)
+
     def retrieve_collection(self):
         collection_dict={}
-        time.sleep(2.05)
-        collections = self.zot.collections()
+        collections = self.call(self.zot.collections)
         for idx in range(len(collections)):
             name, key = collections[idx]['data']['name'], collections[idx]['data']['key']
             collection_dict[name] = key
@@ -16,7 +31,7 @@ class Zotero:
     
     def retrieve_collection_papers(self, key):
         collection_papers=[]
-        items = self.zot.collection_items(key)
+        items = self.call(self.zot.collection_items, key)
         for idx in range(len(items)):
             try:
                 title, DOI = items[idx]['data']['title'], items[idx]['data']['DOI']